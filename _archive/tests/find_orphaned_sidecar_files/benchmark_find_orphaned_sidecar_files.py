@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""benchmark for find_orphaned_sidecar_files.py
+
+scaling: Times get_orphaned_files on synthetic folders of growing size and
+         checks that the runtime scales linearly with the number of entries.
+tree:    Generates a synthetic photo tree and times get_orphaned_files and
+         find_files separately."""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 Georg Lutz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Standard library imports:
+import argparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+
+TESTSCRIPT_DIR = os.path.dirname(__file__)
+SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir, os.pardir))
+sys.path.append(SCRIPT_DIR)
+import find_orphaned_sidecar_files # pylint: disable=import-error,wrong-import-position
+
+
+def get_args():
+    '''Configures command line parser and returns parsed parameters'''
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for find_orphaned_sidecar_files.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scaling = subparsers.add_parser(
+        "scaling", help="Check that get_orphaned_files scales linearly")
+    scaling.add_argument(
+        "-n", "--entries", type=int, default=100000,
+        help="Number of entries in the largest synthetic folder. Defaults to 100000")
+    scaling.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of timing runs per size, the best one is taken. Defaults to 3")
+    scaling.add_argument(
+        "--max-ratio", type=float, default=3.0,
+        help="Maximum allowed runtime growth factor when doubling the folder size. "
+        "Defaults to 3.0")
+
+    tree = subparsers.add_parser(
+        "tree", help="Time get_orphaned_files and find_files on a synthetic tree")
+    tree.add_argument(
+        "--depth", type=int, default=3,
+        help="Number of folder levels below the base folder. Defaults to 3")
+    tree.add_argument(
+        "--fanout", type=int, default=5,
+        help="Number of subfolders per folder. Defaults to 5")
+    tree.add_argument(
+        "--files", type=int, default=100,
+        help="Number of base files per folder. Defaults to 100")
+    tree.add_argument(
+        "--sidecar-ratio", type=float, default=1.0,
+        help="Average number of sidecar files per base file. Defaults to 1.0")
+    tree.add_argument(
+        "--orphan-ratio", type=float, default=0.1,
+        help="Share of base files which are removed again. Defaults to 0.1")
+    tree.add_argument(
+        "--tmpdir", default="/dev/shm" if os.path.isdir("/dev/shm") else None,
+        help="Where to generate the tree, should be a tmpfs. Defaults to /dev/shm")
+    tree.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Passed on to find_files. Defaults to 1")
+    tree.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of timing runs, the best one is taken. Defaults to 3")
+    return parser.parse_args()
+
+
+def generate_folder(num_entries):
+    '''Returns a synthetic file list with about num_entries entries
+
+    Every image comes with an XMP and a PP3 sidecar, every 10th image is
+    missing so that its sidecars are orphaned.'''
+    result = []
+    for i in range(num_entries // 3):
+        if i % 10:
+            result.append("IMG_%06d.CR2" % i)
+        result.append("IMG_%06d.CR2.xmp" % i)
+        result.append("IMG_%06d.pp3" % i)
+    return result
+
+
+def time_folder(files, repeat):
+    '''Returns the best runtime of get_orphaned_files on files in seconds'''
+    extensions = find_orphaned_sidecar_files.DEFAULT_SIDECAR_EXTENSIONS
+    return min(timeit.repeat(
+        lambda: find_orphaned_sidecar_files.get_orphaned_files(files, extensions),
+        number=1, repeat=repeat))
+
+
+def generate_tree(base_folder, depth, fanout, files, sidecar_ratio, orphan_ratio, seed=0):
+    '''Generates a synthetic photo tree below base_folder
+
+    Every folder gets files base files, each with on average sidecar_ratio
+    sidecar files (XMP first, then PP3). A share of orphan_ratio base files is
+    not created, so their sidecar files are orphaned.
+
+    Returns the number of created files'''
+    rnd = random.Random(seed)
+    count = 0
+    folders = [base_folder]
+    level = [base_folder]
+    for _ in range(depth):
+        level = [os.path.join(folder, "dir%03d" % i) for folder in level
+                 for i in range(fanout)]
+        for folder in level:
+            os.mkdir(folder)
+        folders.extend(level)
+    for folder in folders:
+        for i in range(files):
+            name = "IMG_%06d.CR2" % i
+            sidecars = int(sidecar_ratio) + (rnd.random() < sidecar_ratio % 1)
+            names = [name + ".xmp", "IMG_%06d.pp3" % i][:sidecars]
+            if rnd.random() >= orphan_ratio:
+                names.append(name)
+            for entry in names:
+                with open(os.path.join(folder, entry), "w"):
+                    pass
+            count += len(names)
+    return count
+
+
+def get_peak_rss_mb():
+    '''Returns the peak resident set size of this process in MB'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024
+
+
+def run_scaling(args):
+    '''Checks that get_orphaned_files scales linearly, exits with 1 if not'''
+    sizes = [args.entries // 8, args.entries // 4, args.entries // 2, args.entries]
+    previous = None
+    linear = True
+    print("entries;seconds;entries_per_s;ratio")
+    for size in sizes:
+        files = generate_folder(size)
+        seconds = time_folder(files, args.repeat)
+        ratio = seconds / previous if previous else 0.0
+        print("%d;%f;%d;%.2f" % (len(files), seconds, len(files) / seconds, ratio))
+        if previous and ratio > args.max_ratio:
+            linear = False
+        previous = seconds
+
+    if not linear:
+        print("Runtime grows faster than linear")
+        sys.exit(1)
+
+
+def run_tree(args):
+    '''Times get_orphaned_files and find_files on a generated tree'''
+    tmpdir = tempfile.mkdtemp(prefix="benchmark_find_orphaned_", dir=args.tmpdir)
+    try:
+        base_folder = os.path.join(tmpdir, "pics")
+        os.mkdir(base_folder)
+        start = time.perf_counter()
+        num_files = generate_tree(base_folder, args.depth, args.fanout, args.files,
+                                  args.sidecar_ratio, args.orphan_ratio)
+        print("Generated %d files in %s in %.2f s" % (
+            num_files, base_folder, time.perf_counter() - start))
+
+        extensions = find_orphaned_sidecar_files.DEFAULT_SIDECAR_EXTENSIONS
+        listings = [files for _, _, files in os.walk(base_folder)]
+        seconds = min(timeit.repeat(
+            lambda: [find_orphaned_sidecar_files.get_orphaned_files(files, extensions)
+                     for files in listings],
+            number=1, repeat=args.repeat))
+        print("phase;seconds;files_per_s;peak_rss_mb")
+        print("get_orphaned_files;%f;%d;%.1f" % (
+            seconds, num_files / seconds, get_peak_rss_mb()))
+
+        seconds = min(timeit.repeat(
+            lambda: list(find_orphaned_sidecar_files.find_files(
+                base_folder, extensions, jobs=args.jobs)),
+            number=1, repeat=args.repeat))
+        print("find_files;%f;%d;%.1f" % (seconds, num_files / seconds, get_peak_rss_mb()))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    '''main function, called when script file is executed directly'''
+    args = get_args()
+    if args.command == "scaling":
+        run_scaling(args)
+    else:
+        run_tree(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,14 +25,17 @@
 # THE SOFTWARE.
 
 # Standard library imports:
+import io
+import json
 import os
 import sys
+import tempfile
 import unittest
 import unittest.mock
 
 
 TESTSCRIPT_DIR = os.path.dirname(__file__)
-SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir))
+SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir, os.pardir))
 sys.path.append(SCRIPT_DIR)
 import find_orphaned_sidecar_files # pylint: disable=import-error,wrong-import-position
 
@@ -124,6 +127,55 @@ class TestOrphanedFiles(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
 
+    def test_orphans_order_and_iterables(self):
+        '''orphans keep input order, arguments can be any iterable'''
+
+        sidecar_extensions = ("xmp", "pp3")
+        list_of_files = iter([
+            "b.jpg.pp3",
+            "a.jpg",
+            "a.jpg.xmp",
+            "c.xmp",
+            "a.pp3"
+        ])
+        expected_result = [
+            "b.jpg.pp3",
+            "c.xmp"
+        ]
+        result = find_orphaned_sidecar_files.get_orphaned_files(list_of_files, sidecar_extensions)
+        self.assertEqual(result, expected_result)
+
+
+class TestClassifyFiles(unittest.TestCase):
+    '''test classify_files'''
+
+    def test_all_categories(self):
+        '''orphans, base files without sidecar and duplicate sidecars'''
+
+        sidecar_extensions = ["xmp", "pp3"]
+        list_of_files = [
+            "file1.cr2",
+            "file1.xmp",
+            "file1.cr2.xmp",
+            "file1.cr2.pp3",
+            "file2.cr2",
+            "file3.jpg",
+            "file3.jpg.xmp",
+            "file4.jpg.xmp",
+            "notes.txt"
+        ]
+        expected_result = [
+            ("orphaned", "file4.jpg.xmp"),
+            ("missing", "file2.cr2"),
+            ("duplicate", "file1.cr2.xmp"),
+            ("duplicate", "file1.xmp")
+        ]
+        result = find_orphaned_sidecar_files.classify_files(
+            list_of_files, sidecar_extensions,
+            find_orphaned_sidecar_files.CATEGORIES, ["cr2", "jpg"])
+        self.assertEqual(result, expected_result)
+
+
 class TestFindFiles(unittest.TestCase):
     '''test find_files'''
 
@@ -148,5 +200,199 @@ class TestFindFiles(unittest.TestCase):
             self.assertEqual(result, expected)
 
 
+    def test_find_files_parallel_sorted(self):
+        '''parallel walk in sorted order, symlink loops are followed only once'''
+
+        sidecar_extensions = ["xmp"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for path in ["b/c", "a"]:
+                os.makedirs(os.path.join(tmpdir, path))
+            for path in ["z.xmp", "b/file1.jpg", "b/file1.jpg.xmp", "b/c/file2.xmp",
+                         "a/file3.xmp", "a/file4.xmp"]:
+                with open(os.path.join(tmpdir, path), "w"):
+                    pass
+            os.symlink(tmpdir, os.path.join(tmpdir, "b", "loop"))
+            expected = [os.path.join(tmpdir, path) for path in
+                        ["z.xmp", "a/file3.xmp", "a/file4.xmp", "b/c/file2.xmp"]]
+
+            result = list(find_orphaned_sidecar_files.find_files(
+                tmpdir, sidecar_extensions, jobs=4, sort=True))
+            self.assertEqual(result, expected)
+
+            result = list(find_orphaned_sidecar_files.find_files(
+                tmpdir, sidecar_extensions, jobs=4))
+            self.assertEqual(sorted(result), sorted(expected))
+
+
+class TestOrphanCache(unittest.TestCase):
+    '''test find_files with OrphanCache'''
+
+    def test_unchanged_folders_from_cache(self):
+        '''second run takes unchanged folders from the cache'''
+
+        sidecar_extensions = ["xmp"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = os.path.join(tmpdir, "pics")
+            os.makedirs(os.path.join(folder, "dir1"))
+            os.makedirs(os.path.join(folder, "dir2"))
+            for path in ["dir1/file1.xmp", "dir2/file2.jpg", "dir2/file2.xmp"]:
+                with open(os.path.join(folder, path), "w"):
+                    pass
+            cachefile = os.path.join(tmpdir, "cache.sqlite")
+
+            def run():
+                cache = find_orphaned_sidecar_files.OrphanCache(
+                    cachefile, folder, sidecar_extensions)
+                result = list(find_orphaned_sidecar_files.find_files(
+                    folder, sidecar_extensions, sort=True, cache=cache))
+                cache.save()
+                return result, cache
+
+            result, cache = run()
+            self.assertEqual(result, [os.path.join(folder, "dir1", "file1.xmp")])
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+            os.remove(os.path.join(folder, "dir2", "file2.jpg"))
+            result, cache = run()
+            self.assertEqual(result, [os.path.join(folder, "dir1", "file1.xmp"),
+                                      os.path.join(folder, "dir2", "file2.xmp")])
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class TestQuarantine(unittest.TestCase):
+    '''test quarantine_files and restore_files'''
+
+    def test_quarantine_and_restore(self):
+        '''files are moved to quarantine and back'''
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            folder = os.path.join(tmpdir, "pics")
+            quarantine = os.path.join(tmpdir, "quarantine")
+            os.makedirs(os.path.join(folder, "dir1"))
+            files = [os.path.join(folder, "file1.xmp"), os.path.join(folder, "dir1", "file2.xmp")]
+            for file_ in files:
+                with open(file_, "w"):
+                    pass
+
+            result = list(find_orphaned_sidecar_files.quarantine_files(files, folder, quarantine))
+            self.assertEqual(result, files)
+            for file_ in files:
+                self.assertFalse(os.path.exists(file_))
+            self.assertTrue(os.path.exists(os.path.join(quarantine, "dir1", "file2.xmp")))
+
+            manifest = os.path.join(quarantine, find_orphaned_sidecar_files.MANIFEST_NAME)
+            result = list(find_orphaned_sidecar_files.restore_files(manifest))
+            self.assertEqual(result, files)
+            for file_ in files:
+                self.assertTrue(os.path.exists(file_))
+
+
+class TestResultWriter(unittest.TestCase):
+    '''test ResultWriter'''
+
+    def write(self, output_format):
+        '''Writes two entries in output_format and returns the output'''
+        stream = io.BytesIO()
+        writer = find_orphaned_sidecar_files.ResultWriter(stream, output_format, chunk_size=1)
+        stat = os.stat_result((0, 0, 0, 0, 0, 0, 42, 0, 1000, 0))
+        writer.write("/dir1/file1.xmp", stat)
+        writer.write("/dir1/file2.xmp", stat)
+        writer.close()
+        return stream.getvalue()
+
+    def test_plain(self):
+        '''one path per line'''
+        self.assertEqual(self.write("plain"), b"/dir1/file1.xmp\n/dir1/file2.xmp\n")
+
+    def test_null(self):
+        '''NUL terminated paths'''
+        self.assertEqual(self.write("null"), b"/dir1/file1.xmp\0/dir1/file2.xmp\0")
+
+    def test_jsonl(self):
+        '''JSON lines with size and mtime'''
+        lines = self.write("jsonl").decode().splitlines()
+        self.assertEqual(json.loads(lines[1]),
+                         {"category": "orphaned", "path": "/dir1/file2.xmp", "size": 42,
+                          "mtime": 1000})
+
+    def test_csv(self):
+        '''CSV with header'''
+        self.assertEqual(self.write("csv"),
+                         b"category,path,size,mtime,original\n"
+                         b"orphaned,/dir1/file1.xmp,42,1000,\norphaned,/dir1/file2.xmp,42,1000,\n")
+
+    def test_flush_interval(self):
+        '''output is flushed once flush_interval passed since the last flush'''
+        stream = io.BytesIO()
+        with unittest.mock.patch.object(find_orphaned_sidecar_files.time, "monotonic",
+                               side_effect=[0, 0.5, 1.5, 1.5, 1.6]):
+            writer = find_orphaned_sidecar_files.ResultWriter(stream)
+            writer.write("/dir1/file1.xmp")
+            self.assertEqual(stream.getvalue(), b"")
+            writer.write("/dir1/file2.xmp")
+            self.assertEqual(stream.getvalue(), b"/dir1/file1.xmp\n/dir1/file2.xmp\n")
+            writer.write("/dir1/file3.xmp")
+            self.assertEqual(stream.getvalue(), b"/dir1/file1.xmp\n/dir1/file2.xmp\n")
+
+
+class TestReattach(unittest.TestCase):
+    '''test get_xmp_references and FilenameIndex'''
+
+    XMP = b'''<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:crs="http://ns.adobe.com/camera-raw-settings/1.0/"
+    xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/"
+    xmlns:stRef="http://ns.adobe.com/xap/1.0/sType/ResourceRef#"
+    crs:RawFileName="IMG_0001.CR2">
+   <xmpMM:DerivedFrom rdf:parseType="Resource">
+    <stRef:filePath>/old/place/IMG_0001.JPG</stRef:filePath>
+   </xmpMM:DerivedFrom>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>'''
+
+    XMP_ATTRIBUTES = b'''<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/"
+    xmlns:stRef="http://ns.adobe.com/xap/1.0/sType/ResourceRef#">
+   <xmpMM:DerivedFrom stRef:filePath="IMG_1.CR2"/>
+   <xmpMM:DerivedFrom rdf:parseType="Resource">
+    <stRef:documentID>xmp.did:1</stRef:documentID>
+    <stRef:instanceID>xmp.iid:1</stRef:instanceID>
+   </xmpMM:DerivedFrom>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>'''
+
+    def get_references(self, data):
+        '''Returns get_xmp_references() for an XMP file with data'''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "file.xmp")
+            with open(filename, "wb") as file_:
+                file_.write(data)
+            return find_orphaned_sidecar_files.get_xmp_references(filename)
+
+    def test_xmp_references(self):
+        '''attribute and resource reference'''
+        self.assertEqual(self.get_references(self.XMP), ["IMG_0001.CR2", "IMG_0001.JPG"])
+
+    def test_xmp_references_attributes(self):
+        '''stRef:filePath as attribute of DerivedFrom, document ids are ignored'''
+        self.assertEqual(self.get_references(self.XMP_ATTRIBUTES), ["IMG_1.CR2"])
+
+    def test_filename_index(self):
+        '''lookup of file names in several folders'''
+
+        index = find_orphaned_sidecar_files.FilenameIndex()
+        index.add_folder("/dir2", ["b.jpg", "a.jpg"])
+        index.add_folder("/dir1", ["a.jpg", "c.jpg"])
+        index.finalize()
+        self.assertEqual(sorted(index.lookup("a.jpg")), ["/dir1/a.jpg", "/dir2/a.jpg"])
+        self.assertEqual(index.lookup("c.jpg"), ["/dir1/c.jpg"])
+        self.assertEqual(index.lookup("d.jpg"), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""benchmark for get_clip_list.py
+
+Times the full ffprobe, the fast ffprobe and the mvhd parser probe modes on
+the clips of a folder."""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Georg Lutz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Standard library imports:
+import argparse
+import logging
+import os
+import sys
+import time
+
+
+TESTSCRIPT_DIR = os.path.dirname(__file__)
+SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir, os.pardir))
+sys.path.append(SCRIPT_DIR)
+import get_clip_list # pylint: disable=import-error,wrong-import-position
+
+
+def get_args():
+    '''Configures command line parser and returns parsed parameters'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark the probe modes of get_clip_list on a folder of clips")
+    parser.add_argument(
+        "folder",
+        help="Folder name of video clips.")
+    return parser.parse_args()
+
+
+def time_mode(files, probe):
+    '''Returns (seconds, number of successfully probed files) for probe on files'''
+    start = time.perf_counter()
+    success = sum(1 for file_ in files if probe(file_) is not None)
+    return time.perf_counter() - start, success
+
+
+def main():
+    '''main function, called when script file is executed directly'''
+    args = get_args()
+    logging.basicConfig(format="%(message)s", level=logging.ERROR)
+
+    files = list(get_clip_list.iter_file_list(args.folder))
+    mp4_files = [file_ for file_ in files
+                 if os.path.splitext(file_)[1].lower() in get_clip_list.MVHD_EXTENSIONS]
+    modes = [
+        ("ffprobe", files, get_clip_list.get_json_info_ffprobe),
+        ("ffprobe_fast", files, lambda file_: get_clip_list.get_json_info_ffprobe(file_, True)),
+        ("ffprobe_mp4", mp4_files, get_clip_list.get_json_info_ffprobe),
+        ("ffprobe_fast_mp4", mp4_files,
+         lambda file_: get_clip_list.get_json_info_ffprobe(file_, True)),
+        ("mvhd_mp4", mp4_files, get_clip_list.get_json_info_mvhd),
+    ]
+    print("mode;files;probed;seconds;ms_per_file")
+    for name, mode_files, probe in modes:
+        if not mode_files:
+            continue
+        seconds, success = time_mode(mode_files, probe)
+        print("%s;%d;%d;%f;%.2f" % (
+            name, len(mode_files), success, seconds, seconds * 1000 / len(mode_files)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""tests for get_clip_list.py"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Georg Lutz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Standard library imports:
+import asyncio
+import datetime
+import json
+import os
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+TESTSCRIPT_DIR = os.path.dirname(__file__)
+SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir, os.pardir))
+sys.path.append(SCRIPT_DIR)
+import get_clip_list # pylint: disable=import-error,wrong-import-position
+
+
+def mp4_box(box_type, payload):
+    '''Returns an MP4 box with the given type and payload'''
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+class TestParseMvhd(unittest.TestCase):
+    '''test parse_mvhd'''
+
+    def test_version0(self):
+        '''32 bit mvhd after the media data'''
+
+        creation = (datetime.datetime(2019, 4, 12, 15, 59, 29) - get_clip_list.MVHD_EPOCH)
+        mvhd = b"\0\0\0\0" + struct.pack(
+            ">IIII", int(creation.total_seconds()), 0, 1000, 24920) + b"\0" * 80
+        data = (mp4_box(b"ftyp", b"isom\0\0\0\0") + mp4_box(b"mdat", b"\0" * 1000) +
+                mp4_box(b"moov", mp4_box(b"mvhd", mvhd)))
+        result = get_clip_list.parse_mvhd(data)
+        self.assertEqual(result, (24.92, datetime.datetime(2019, 4, 12, 15, 59, 29)))
+
+    def test_version1_no_creation_time(self):
+        '''64 bit mvhd without creation time'''
+
+        mvhd = b"\1\0\0\0" + struct.pack(">QQIQ", 0, 0, 90000, 900000) + b"\0" * 80
+        data = mp4_box(b"moov", mp4_box(b"trak", b"") + mp4_box(b"mvhd", mvhd))
+        result = get_clip_list.parse_mvhd(data)
+        self.assertEqual(result, (10.0, None))
+
+    def test_no_moov(self):
+        '''no moov box'''
+
+        data = mp4_box(b"ftyp", b"isom\0\0\0\0") + b"\0" * 100
+        self.assertIsNone(get_clip_list.parse_mvhd(data))
+
+
+class TestColumnsFromProbe(unittest.TestCase):
+    '''test get_columns_from_probe'''
+
+    def test_video_and_audio(self):
+        '''columns from video, audio and format section'''
+
+        json_decoded = {
+            "streams": [
+                {"codec_type": "audio", "codec_name": "aac", "channels": 2,
+                 "sample_rate": "48000"},
+                {"codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080,
+                 "avg_frame_rate": "30000/1001", "duration": "24.920000",
+                 "tags": {"creation_time": "2019-04-12T15:59:29.000000Z"}}
+            ],
+            "format": {"format_name": "mov,mp4", "bit_rate": "20000000"}
+        }
+        expected = {
+            "duration_s": "24.920000",
+            "timestamp": datetime.datetime(2019, 4, 12, 15, 59, 29),
+            "codec": "h264",
+            "width": 1920,
+            "height": 1080,
+            "fps": 29.97,
+            "bitrate": "20000000",
+            "container": "mov,mp4",
+            "audio_codec": "aac",
+            "audio_channels": 2,
+            "audio_sample_rate": "48000",
+            "audio_streams": 1
+        }
+        self.assertEqual(get_clip_list.get_columns_from_probe(json_decoded), expected)
+
+    def test_creation_time_formats(self):
+        '''creation_time without fractional seconds, an invalid one keeps the other columns'''
+
+        def get_columns(creation_time):
+            '''returns the columns of a video stream with creation_time'''
+            return get_clip_list.get_columns_from_probe({"streams": [
+                {"codec_type": "video", "codec_name": "h264", "duration": "1.5",
+                 "tags": {"creation_time": creation_time}}]})
+
+        self.assertEqual(get_columns("2019-04-12T15:59:29Z")["timestamp"],
+                         datetime.datetime(2019, 4, 12, 15, 59, 29))
+        with self.assertLogs(level="WARNING"):
+            columns = get_columns("yesterday")
+        self.assertNotIn("timestamp", columns)
+        self.assertEqual((columns["duration_s"], columns["codec"]), ("1.5", "h264"))
+
+
+class TestIsVideoFile(unittest.TestCase):
+    '''test is_video_file'''
+
+    def check(self, filename, header):
+        '''Writes header to filename in a temporary folder and returns is_video_file'''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, filename)
+            with open(path, "wb") as file_:
+                file_.write(header)
+            return get_clip_list.is_video_file(path)
+
+    def test_extension(self):
+        '''known extensions are accepted without reading the file'''
+        self.assertTrue(self.check("clip.MTS", b""))
+
+    def test_magic(self):
+        '''unknown extensions are sniffed'''
+        self.assertTrue(self.check("clip", b"\0\0\0\x18ftypmp42\0\0\0\0"))
+        self.assertTrue(self.check("clip.bin", b"\x1a\x45\xdf\xa3" + b"\0" * 12))
+        packet = b"\x47\x40\0\x10" + b"\0" * 184
+        self.assertTrue(self.check("clip.bin", packet * 2))
+        self.assertTrue(self.check("clip.bin", (b"\0\0\0\0" + packet) * 2))
+        self.assertFalse(self.check("clip.bin", packet))
+        self.assertFalse(self.check("CLIP.THM", b"\xff\xd8\xff\xe0\0\x10JFIF\0" + b"\0" * 6))
+        self.assertFalse(self.check("clip.XML", b"<?xml version="))
+        self.assertFalse(self.check("anim.gif", b"GIF89a" + b"\0" * 10))
+        self.assertFalse(self.check("notes.txt", b"Good morning\n" * 40))
+        self.assertFalse(self.check("notes.txt", b"ABC\nGood morning\n" * 30))
+
+
+class TestSummary(unittest.TestCase):
+    '''test Summary'''
+
+    CLIPS = [
+        {"filename": "day1/a.MP4", "size_mb": 1.5, "duration_s": "10.5",
+         "timestamp": datetime.datetime(2019, 4, 12, 16, 0, 0)},
+        {"filename": "day1/b.MP4", "size_mb": 2.5, "duration_s": "20.0",
+         "timestamp": datetime.datetime(2019, 4, 12, 15, 0, 0)},
+        {"filename": "c.MP4", "size_mb": 1.0, "error": "timeout"},
+    ]
+
+    def test_by_date(self):
+        '''grouped by date, clips without timestamp are unknown'''
+        summary = get_clip_list.Summary("date")
+        for clip in self.CLIPS:
+            summary.add(clip)
+        self.assertEqual(summary.rows(), [
+            {"group": "2019-04-12", "clips": 2, "duration_s": 30.5, "size_mb": 4.0,
+             "first_timestamp": datetime.datetime(2019, 4, 12, 15, 0, 0),
+             "last_timestamp": datetime.datetime(2019, 4, 12, 16, 0, 0)},
+            {"group": "unknown", "clips": 1, "duration_s": 0.0, "size_mb": 1.0,
+             "first_timestamp": None, "last_timestamp": None}])
+
+    def test_by_folder(self):
+        '''grouped by subfolder'''
+        summary = get_clip_list.Summary("folder")
+        for clip in self.CLIPS:
+            summary.add(clip)
+        self.assertEqual([(row["group"], row["clips"]) for row in summary.rows()],
+                         [(".", 1), ("day1", 2)])
+
+
+class TestDuplicateFinder(unittest.TestCase):
+    '''test DuplicateFinder'''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.finder = get_clip_list.DuplicateFinder(self.tempdir.name)
+        self.finder.PARTIAL_HASH_SIZE = 4
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def check(self, filename, content, duration_s="1.0"):
+        '''Writes filename and passes it to the finder'''
+        with open(os.path.join(self.tempdir.name, filename), "wb") as file_:
+            file_.write(content)
+        return self.finder.check({"filename": filename, "size_mb": len(content) / 1e6,
+                                  "duration_s": duration_s})
+
+    def test_duplicates(self):
+        '''only identical content with same size and duration is a duplicate'''
+        self.assertIsNone(self.check("a.MP4", b"0123456789abcdef"))
+        self.assertEqual(self.check("b.MP4", b"0123456789abcdef"), "a.MP4")
+        # same head and tail, differs in the middle -> full hash decides
+        self.assertIsNone(self.check("c.MP4", b"0123XXXXXXXXcdef"))
+        self.assertEqual(self.check("d.MP4", b"0123XXXXXXXXcdef"), "c.MP4")
+        self.assertIsNone(self.check("e.MP4", b"0123456789abcdef", "2.0"))
+        self.assertIsNone(self.finder.check({"filename": "f.MP4", "size_mb": 1.0,
+                                             "error": "timeout"}))
+
+
+FFPROBE_STUB = '''#!/bin/sh
+for last; do :; done
+case "$last" in
+    *slow*) echo $$ >> "$FFPROBE_STUB_PIDS"; exec sleep 60;;
+    *fail*) echo "invalid data" >&2; exit 1;;
+esac
+echo '{"streams": [{"codec_type": "video", "duration": "1.5"}], "format": {}}'
+'''
+
+
+class FfprobeStubTestCase(unittest.TestCase):
+    '''base class for tests running a stub ffprobe on clips in self.folder'''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        stub = os.path.join(self.tempdir.name, "ffprobe")
+        with open(stub, "w", encoding="utf-8") as file_:
+            file_.write(FFPROBE_STUB)
+        os.chmod(stub, 0o755)
+        self.pidfile = os.path.join(self.tempdir.name, "pids")
+        patcher = mock.patch.dict(os.environ, {
+            "PATH": self.tempdir.name + os.pathsep + os.environ["PATH"],
+            "FFPROBE_STUB_PIDS": self.pidfile})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.folder = os.path.join(self.tempdir.name, "clips")
+        os.mkdir(self.folder)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def create(self, *names):
+        '''Creates empty clips in folder, returns their paths'''
+        paths = [os.path.join(self.folder, name) for name in names]
+        for path in paths:
+            with open(path, "wb"):
+                pass
+        return paths
+
+
+class TestRunFfprobe(FfprobeStubTestCase):
+    '''test timeout, kill and reap of ffprobe processes with a stub ffprobe'''
+
+    def read_pids(self):
+        '''Returns the pids of the slow ffprobe processes started so far'''
+        if not os.path.exists(self.pidfile):
+            return []
+        with open(self.pidfile, encoding="utf-8") as file_:
+            return [int(line) for line in file_]
+
+    def assert_reaped(self):
+        '''Checks that all slow ffprobe processes are gone, not even zombies'''
+        pids = self.read_pids()
+        self.assertTrue(pids)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+    def test_timeout(self):
+        '''ffprobe is killed and reaped after timeout, failures have a reason'''
+        slow, failing = self.create("slow.MP4", "fail.MP4")
+        start = time.monotonic()
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(asyncio.run(get_clip_list.run_ffprobe(slow, timeout=0.5)),
+                             (None, "timeout"))
+        self.assertLess(time.monotonic() - start, 10)
+        self.assert_reaped()
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(asyncio.run(get_clip_list.run_ffprobe(failing)),
+                             (None, "ffprobe exit code 1"))
+
+    def test_close_early(self):
+        '''closing the generator cancels pending probes and kills their processes'''
+        files = self.create("a.MP4", "slow1.MP4", "slow2.MP4")
+        start = time.monotonic()
+        clips = get_clip_list.iter_clips_info(self.folder, files, jobs=3, timeout=60)
+        self.assertEqual(next(clips)["duration_s"], "1.5")
+        while len(self.read_pids()) < 2:
+            time.sleep(0.05)
+        clips.close()
+        self.assertLess(time.monotonic() - start, 10)
+        self.assert_reaped()
+
+    @unittest.skipUnless(hasattr(signal, "pthread_kill"), "needs pthread_kill")
+    def test_interrupt(self):
+        '''Ctrl-C during running probes kills their processes and is re-raised'''
+        files = self.create("slow1.MP4", "slow2.MP4", "slow3.MP4", "slow4.MP4")
+        handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.addCleanup(signal.signal, signal.SIGINT, handler)
+
+        def interrupt():
+            '''sends SIGINT to the main thread once both probes are running'''
+            while len(self.read_pids()) < 2:
+                time.sleep(0.05)
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+        thread = threading.Thread(target=interrupt, daemon=True)
+        thread.start()
+        start = time.monotonic()
+        with self.assertRaises(KeyboardInterrupt):
+            list(get_clip_list.iter_clips_info(self.folder, files, jobs=2, timeout=60))
+        thread.join()
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(len(self.read_pids()), 2)
+        self.assert_reaped()
+
+    def test_error_column(self):
+        '''the reason of a failed probe is in the default CSV columns'''
+        files = self.create("a.MP4", "slow.MP4")
+        csvfile = os.path.join(self.tempdir.name, "out.csv")
+        with self.assertLogs(level="WARNING"):
+            get_clip_list.write_clips_info(
+                get_clip_list.iter_clips_info(self.folder, files, timeout=0.5), csvfile)
+        with open(csvfile, encoding="utf-8") as file_:
+            self.assertEqual(file_.read().splitlines(), [
+                "filename;size_mb;duration_s;timestamp;error",
+                "a.MP4;0.0;1.5;N/A;N/A",
+                "slow.MP4;0.0;N/A;N/A;timeout"])
+
+
+class TestResume(FfprobeStubTestCase):
+    '''test iter_file_list order, read_done_filenames and --resume'''
+
+    def test_file_order(self):
+        '''files are yielded in the order of the sorted paths'''
+        for name in ("a", "a-b", os.path.join("a", "c")):
+            os.mkdir(os.path.join(self.folder, name))
+        os.symlink(self.folder, os.path.join(self.folder, "link"))
+        files = self.create("b.MP4", os.path.join("a", "y.MP4"), os.path.join("a-b", "x.MP4"),
+                            os.path.join("a", "c", "z.MP4"), "a.MP4", "A.MP4")
+        self.assertEqual(list(get_clip_list.iter_file_list(self.folder)), sorted(files))
+
+    def test_read_done_filenames(self):
+        '''an incomplete last line is removed'''
+        csvfile = os.path.join(self.tempdir.name, "out.csv")
+        self.assertIsNone(get_clip_list.read_done_filenames(csvfile))
+        with open(csvfile, "w", encoding="utf-8") as file_:
+            file_.write("filename;size_mb\na.MP4;1.0\nb.MP4;2.0\nc.MP")
+        self.assertEqual(get_clip_list.read_done_filenames(csvfile), {"a.MP4", "b.MP4"})
+        with open(csvfile, encoding="utf-8") as file_:
+            self.assertEqual(file_.read(), "filename;size_mb\na.MP4;1.0\nb.MP4;2.0\n")
+        jsonfile = os.path.join(self.tempdir.name, "out.jsonl")
+        with open(jsonfile, "w", encoding="utf-8") as file_:
+            file_.write('{"filename": "a.MP4"}\n{"filena')
+        self.assertEqual(get_clip_list.read_done_filenames(jsonfile, "jsonl"), {"a.MP4"})
+
+    def test_resume(self):
+        '''listed files are not probed again, the columns of the file are kept'''
+        os.mkdir(os.path.join(self.folder, "sub"))
+        self.create("a.MP4", "b.MP4", os.path.join("sub", "c.MP4"))
+        csvfile = os.path.join(self.tempdir.name, "out.csv")
+        with open(csvfile, "w", encoding="utf-8") as file_:
+            file_.write("filename;duration_s\na.MP4;9.9\nb.M")
+        argv = ["get_clip_list.py", "--resume", "--no-cache", self.folder, csvfile]
+        with mock.patch.object(sys, "argv", argv), self.assertLogs(level="INFO"):
+            get_clip_list.main()
+        with open(csvfile, encoding="utf-8") as file_:
+            self.assertEqual(file_.read().splitlines(), [
+                "filename;duration_s", "a.MP4;9.9", "b.MP4;1.5", "sub/c.MP4;1.5"])
+
+
+class TestProbeCache(unittest.TestCase):
+    '''test that cached probes skip ffprobe unless the file changed'''
+
+    PROBE = (b'{"streams": [{"codec_type": "video", "duration": "1.5", '
+             b'"tags": {"creation_time": "2019-04-12T15:59:29.000000Z"}}], "format": {}}')
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.addCleanup(self.tempdir.cleanup)
+        self.clip = os.path.join(self.tempdir.name, "a.MP4")
+        with open(self.clip, "wb") as file_:
+            file_.write(b"1234")
+        patcher = mock.patch.object(get_clip_list, "run_ffprobe",
+                                    mock.AsyncMock(return_value=(self.PROBE, None)))
+        self.run_ffprobe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def probe(self):
+        '''Returns the info on the clip using a new cache on the same file'''
+        cache = get_clip_list.ProbeCache(os.path.join(self.tempdir.name, "cache", "probes.sqlite"))
+        try:
+            info = get_clip_list.get_clips_info(self.tempdir.name, [self.clip], cache=cache)
+        finally:
+            cache.close()
+        self.assertEqual(info[0]["duration_s"], "1.5")
+        return cache
+
+    def test_hit(self):
+        '''a second run with an unchanged file does not run ffprobe'''
+        cache = self.probe()
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        cache = self.probe()
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(self.run_ffprobe.call_count, 1)
+
+    def test_changed_size(self):
+        '''a file with a different size is probed again'''
+        self.probe()
+        stat = os.stat(self.clip)
+        with open(self.clip, "ab") as file_:
+            file_.write(b"5")
+        os.utime(self.clip, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        cache = self.probe()
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(self.run_ffprobe.call_count, 2)
+
+    def test_changed_mtime(self):
+        '''a file with a different mtime_ns is probed again'''
+        self.probe()
+        stat = os.stat(self.clip)
+        os.utime(self.clip, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        cache = self.probe()
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(self.run_ffprobe.call_count, 2)
+
+
+class TestJobs(unittest.TestCase):
+    '''test that parallel probes keep the order of the file list'''
+
+    def test_order(self):
+        '''later files finish first, the result is still in filelist order'''
+        with tempfile.TemporaryDirectory() as folder:
+            files = []
+            for i in range(8):
+                files.append(os.path.join(folder, "%d.MP4" % i))
+                with open(files[-1], "wb"):
+                    pass
+            finished = []
+            running = [0, 0]
+
+            async def run_ffprobe(file_, fast, timeout): # pylint: disable=unused-argument
+                running[0] += 1
+                running[1] = max(running)
+                await asyncio.sleep(0.01 * (8 - files.index(file_)))
+                running[0] -= 1
+                finished.append(os.path.basename(file_))
+                probe = {"streams": [{"codec_type": "video", "duration": file_}], "format": {}}
+                return json.dumps(probe).encode(), None
+
+            with mock.patch.object(get_clip_list, "run_ffprobe", run_ffprobe), \
+                    self.assertLogs(level="WARNING"):
+                info = get_clip_list.get_clips_info(folder, files, jobs=4)
+        self.assertEqual([row["filename"] for row in info], ["%d.MP4" % i for i in range(8)])
+        self.assertEqual([row["duration_s"] for row in info], files)
+        self.assertNotEqual(finished, sorted(finished))
+        self.assertEqual(running[1], 4)
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+class TestWatchFolder(unittest.TestCase):
+    '''test Inotify and watch_folder'''
+
+    DEBOUNCE = 0.3
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.folder = self.tempdir.name
+        self.write("old.MP4")
+        self.watcher = get_clip_list.watch_folder(self.folder, self.DEBOUNCE)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tempdir.cleanup()
+
+    def write(self, name, mode="wb"):
+        '''Writes some data to name in folder'''
+        with open(os.path.join(self.folder, name), mode) as file_:
+            file_.write(b"data")
+
+    def next_file(self):
+        '''Returns the next file of the watcher relative to folder, fails after 10 s'''
+        result = []
+        thread = threading.Thread(target=lambda: result.append(next(self.watcher)), daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(len(result), 1, "watch_folder did not yield a file")
+        return os.path.relpath(result[0], self.folder)
+
+    def test_existing_and_new_files(self):
+        '''existing files, new files and files in new subfolders are yielded'''
+        self.assertEqual(self.next_file(), "old.MP4")
+        self.write("new.MP4")
+        self.assertEqual(self.next_file(), "new.MP4")
+        os.makedirs(os.path.join(self.folder, "sub", "deeper"))
+        self.write(os.path.join("sub", "deeper", "clip.MP4"))
+        self.assertEqual(self.next_file(), os.path.join("sub", "deeper", "clip.MP4"))
+
+    def test_debounce(self):
+        '''a file is only yielded once it was unchanged for debounce seconds'''
+        self.assertEqual(self.next_file(), "old.MP4")
+        start = time.monotonic()
+        self.write("growing.MP4")
+        timer = threading.Timer(self.DEBOUNCE / 2, self.write, ["growing.MP4", "ab"])
+        timer.start()
+        self.assertEqual(self.next_file(), "growing.MP4")
+        timer.join()
+        self.assertGreaterEqual(time.monotonic() - start, self.DEBOUNCE * 1.5)
+        self.assertEqual(os.path.getsize(os.path.join(self.folder, "growing.MP4")), 8)
+
+    def test_overflow(self):
+        '''files whose events were lost in a queue overflow are found by a rescan'''
+        self.assertEqual(self.next_file(), "old.MP4")
+        read_events = get_clip_list.Inotify.read_events
+
+        def overflow(inotify, timeout=None):
+            '''replaces all events by an overflow'''
+            if read_events(inotify, timeout):
+                return [(get_clip_list.Inotify.IN_Q_OVERFLOW, None)]
+            return []
+
+        with mock.patch.object(get_clip_list.Inotify, "read_events", overflow), \
+                self.assertLogs(level="WARNING"):
+            os.mkdir(os.path.join(self.folder, "sub"))
+            self.write(os.path.join("sub", "lost.MP4"))
+            self.assertEqual({self.next_file(), self.next_file()},
+                             {"old.MP4", os.path.join("sub", "lost.MP4")})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""tests for symlink_picture_list.py"""
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Georg Lutz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Standard library imports:
+import os
+import re
+import sys
+import tempfile
+import unittest
+
+
+TESTSCRIPT_DIR = os.path.dirname(__file__)
+SCRIPT_DIR = os.path.realpath(os.path.join(TESTSCRIPT_DIR, os.pardir, os.pardir, os.pardir))
+sys.path.append(SCRIPT_DIR)
+import symlink_picture_list # pylint: disable=import-error,wrong-import-position
+
+
+class TestGenerateFolderStructure(unittest.TestCase):
+    '''test generate_folder_structure'''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.pictures = os.path.join(self.tempdir.name, "pictures")
+        self.indir = os.path.join(self.tempdir.name, "in")
+        self.outdir = os.path.join(self.tempdir.name, "out")
+        for dirname in (self.pictures, os.path.join(self.indir, "2017", "berlin"), self.outdir):
+            os.makedirs(dirname)
+        self.sources = []
+        for name in ("b.jpg", "a.jpg", "c.jpg"):
+            self.sources.append(os.path.join(self.pictures, name))
+            with open(self.sources[-1], "w", encoding="utf-8"):
+                pass
+        self.write_list(os.path.join("2017", "berlin"), self.sources)
+        with open(os.path.join(self.indir, "2017", "index.md"), "w", encoding="utf-8"):
+            pass
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_list(self, folder, sources):
+        '''Writes filelist.txt with sources to folder in indir'''
+        with open(os.path.join(self.indir, folder, "filelist.txt"), "w",
+                  encoding="utf-8") as file_:
+            file_.write("# comment\n\n" + "\n".join(sources) + "\n")
+
+    def get_links(self, folder):
+        '''Returns a dict name -> symlink target of folder in outdir'''
+        path = os.path.join(self.outdir, folder)
+        return {name: os.readlink(os.path.join(path, name)) for name in os.listdir(path)
+                if os.path.islink(os.path.join(path, name))}
+
+    def test_create(self):
+        '''folders and symlinks are created, a second run changes nothing'''
+        for _ in range(2):
+            symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+            self.assertEqual(self.get_links(os.path.join("2017", "berlin")), {
+                "000_b.jpg": self.sources[0], "001_a.jpg": self.sources[1],
+                "002_c.jpg": self.sources[2]})
+            self.assertEqual(self.get_links("2017"), {
+                "index.md": os.path.abspath(os.path.join(self.indir, "2017", "index.md"))})
+
+    def test_dry_run(self):
+        '''dry run does not touch outdir'''
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir, dry_run=True), 0)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+    def test_conflict(self):
+        '''nothing is changed on conflicts unless force is set'''
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        other = os.path.join(self.tempdir.name, "b.jpg")
+        self.write_list(os.path.join("2017", "berlin"), [other, self.sources[1]])
+        os.remove(os.path.join(self.outdir, "2017", "index.md"))
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir), 1)
+        self.assertNotIn("index.md", os.listdir(os.path.join(self.outdir, "2017")))
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir, force=True), 0)
+        self.assertEqual(self.get_links(os.path.join("2017", "berlin")), {
+            "000_b.jpg": other, "001_a.jpg": self.sources[1], "002_c.jpg": self.sources[2]})
+        self.assertIn("index.md", os.listdir(os.path.join(self.outdir, "2017")))
+
+    def test_sync(self):
+        '''removed and moved entries are removed and renamed'''
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        other = os.path.join(self.tempdir.name, "a.jpg")
+        os.symlink("/nowhere", os.path.join(self.outdir, "2017", "berlin", "stale.jpg"))
+        self.write_list(os.path.join("2017", "berlin"), [self.sources[2], other])
+        plans = symlink_picture_list.plan_folder_structure(self.indir, self.outdir, sync=True)
+        plan = plans[-1]
+        self.assertEqual(plan.rename, [("002_c.jpg", "000_c.jpg")])
+        self.assertEqual(plan.remove, ["000_b.jpg", "stale.jpg"])
+        self.assertEqual(plan.replace, [("001_a.jpg", other)])
+        self.assertEqual((plan.create, plan.conflicts), ([], []))
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir, sync=True), 0)
+        self.assertEqual(self.get_links(os.path.join("2017", "berlin")), {
+            "000_c.jpg": self.sources[2], "001_a.jpg": other})
+
+    def test_modes(self):
+        '''hardlinks, reflinks and copies are created and recognized as unchanged'''
+        with open(self.sources[0], "w", encoding="utf-8") as file_:
+            file_.write("picture data")
+        for mode in ("hardlink", "reflink", "copy"):
+            outdir = os.path.join(self.tempdir.name, mode)
+            for _ in range(2):
+                self.assertEqual(symlink_picture_list.generate_folder_structure(
+                    self.indir, outdir, mode=mode, jobs=2), 0)
+            dest = os.path.join(outdir, "2017", "berlin", "000_b.jpg")
+            self.assertFalse(os.path.islink(dest))
+            with open(dest, encoding="utf-8") as file_:
+                self.assertEqual(file_.read(), "picture data")
+            self.assertEqual(os.path.samefile(dest, self.sources[0]), mode == "hardlink")
+            self.assertEqual(os.stat(dest).st_mtime_ns, os.stat(self.sources[0]).st_mtime_ns)
+
+    def test_sync_to_copies(self):
+        '''symlinks are replaced by copies with sync'''
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir, sync=True, mode="copy"), 0)
+        self.assertEqual(self.get_links(os.path.join("2017", "berlin")), {})
+        self.assertEqual(sorted(os.listdir(os.path.join(self.outdir, "2017", "berlin"))),
+                         ["000_b.jpg", "001_a.jpg", "002_c.jpg"])
+
+
+    def test_sync_copies_reordered(self):
+        '''reordered copies are created anew and the outdated copies removed'''
+        berlin = os.path.join("2017", "berlin")
+        self.write_list(berlin, [self.sources[1]])
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        self.write_list(berlin, [self.sources[0], self.sources[1]])
+        for _ in range(2):
+            self.assertEqual(symlink_picture_list.generate_folder_structure(
+                self.indir, self.outdir, sync=True, mode="copy"), 0)
+            path = os.path.join(self.outdir, berlin)
+            self.assertEqual(sorted(os.listdir(path)), ["000_b.jpg", "001_a.jpg"])
+            self.assertEqual(self.get_links(berlin), {})
+        self.write_list(berlin, [self.sources[1]])
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir, sync=True,
+                                                       mode="copy")
+        self.assertEqual(os.listdir(path), ["000_a.jpg"])
+        self.assertFalse(os.path.islink(os.path.join(path, "000_a.jpg")))
+
+    def test_stats(self):
+        '''syscalls and entries are counted'''
+        symlink_picture_list.STATS = symlink_picture_list.Stats()
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir)
+        counters = symlink_picture_list.STATS.counters
+        self.assertEqual((counters["mkdir"], counters["symlink"], counters["readlink"]), (2, 4, 4))
+        self.assertEqual((counters["created"], counters["unchanged"]), (4, 4))
+        self.assertIn("apply", symlink_picture_list.STATS.times)
+
+    def test_stats_copies(self):
+        '''replaced copies are counted as replaced, not as created'''
+        symlink_picture_list.generate_folder_structure(self.indir, self.outdir, mode="copy")
+        with open(self.sources[0], "w", encoding="utf-8") as file_:
+            file_.write("edited picture")
+        symlink_picture_list.STATS = symlink_picture_list.Stats()
+        self.assertEqual(symlink_picture_list.generate_folder_structure(
+            self.indir, self.outdir, sync=True, mode="copy"), 0)
+        counters = symlink_picture_list.STATS.counters
+        self.assertEqual((counters["replaced"], counters["created"]), (1, 0))
+
+
+
+class TestLoadFilelists(unittest.TestCase):
+    '''test read_list and load_filelists'''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory() # pylint: disable=consider-using-with
+        self.filelist = os.path.join(self.tempdir.name, "filelist.txt")
+        self.existing = os.path.join(self.tempdir.name, "a.jpg")
+        self.missing = os.path.join(self.tempdir.name, "missing.jpg")
+        with open(self.existing, "w", encoding="utf-8"):
+            pass
+        with open(self.filelist, "w", encoding="utf-8") as file_:
+            file_.write("# comment\n\n%s\n  \n%s" % (self.existing, self.missing))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_read_list(self):
+        '''comments and empty lines are skipped, last line without newline'''
+        self.assertEqual(symlink_picture_list.read_list(self.filelist),
+                         [self.existing, self.missing])
+        empty = os.path.join(self.tempdir.name, "empty.txt")
+        with open(empty, "w", encoding="utf-8"):
+            pass
+        self.assertEqual(symlink_picture_list.read_list(empty), [])
+
+    def test_cache(self):
+        '''missing sources are reported, unchanged lists are taken from the cache'''
+        cache = symlink_picture_list.ListCache(os.path.join(self.tempdir.name, "cache.sqlite"))
+        for _ in range(2):
+            with self.assertLogs(level="WARNING") as logs:
+                self.assertEqual(symlink_picture_list.load_filelists([self.filelist], cache),
+                                 {self.filelist: [self.existing, self.missing]})
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn(self.missing, logs.output[0])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+
+    def test_patterns(self):
+        '''glob, regex and include entries are expanded with one walk'''
+        library = os.path.join(self.tempdir.name, "library")
+        for name in ("2015/01/x.jpg", "2015/02/y.jpg", "2015/02/y.mp4", "2016/z.jpg"):
+            os.makedirs(os.path.dirname(os.path.join(library, name)), exist_ok=True)
+            with open(os.path.join(library, name), "w", encoding="utf-8"):
+                pass
+        other = os.path.join(self.tempdir.name, "sub", "other.txt")
+        os.makedirs(os.path.dirname(other))
+        with open(other, "w", encoding="utf-8") as file_:
+            file_.write("%s/2016/*.jpg\ninclude ../filelist2.txt\n" % library)
+        filelist2 = os.path.join(self.tempdir.name, "filelist2.txt")
+        with open(filelist2, "w", encoding="utf-8") as file_:
+            file_.write("%s/**/*.jpg\n" % library)
+            file_.write("re:%s/2015/.*/[xy]\\.(jpg|mp4)\n" % re.escape(library))
+            file_.write("include sub/other.txt\n%s\n" % self.existing)
+        with self.assertLogs(level="DEBUG") as logs:
+            result = symlink_picture_list.load_filelists([filelist2])
+        self.assertIn("1 source folders walked for 3 patterns", logs.output[-1])
+        self.assertTrue(any("Recursive include" in line for line in logs.output))
+        self.assertEqual([os.path.relpath(path, library) for path in result[filelist2][:-1]], [
+            "2015/01/x.jpg", "2015/02/y.jpg", "2016/z.jpg",
+            "2015/01/x.jpg", "2015/02/y.jpg", "2015/02/y.mp4",
+            "2016/z.jpg"])
+        self.assertEqual(result[filelist2][-1], self.existing)
+
+
+    def test_relative_patterns(self):
+        '''patterns starting with ./ and bare patterns match relative paths'''
+        os.makedirs(os.path.join(self.tempdir.name, "src"))
+        for name in ("x.jpg", os.path.join("src", "y.jpg")):
+            with open(os.path.join(self.tempdir.name, name), "w", encoding="utf-8"):
+                pass
+        with open(self.filelist, "w", encoding="utf-8") as file_:
+            file_.write("./src/*.jpg\n*.jpg\nre:./src/.*\\.jpg\n")
+        cwd = os.getcwd()
+        os.chdir(self.tempdir.name)
+        try:
+            result = symlink_picture_list.load_filelists([self.filelist])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(result[self.filelist], ["src/y.jpg", "a.jpg", "x.jpg", "src/y.jpg"])
+
+    def test_literal_with_glob_chars(self):
+        '''existing paths with glob characters are no patterns'''
+        existing = os.path.join(self.tempdir.name, "IMG [1].jpg")
+        with open(existing, "w", encoding="utf-8"):
+            pass
+        with open(self.filelist, "w", encoding="utf-8") as file_:
+            file_.write(existing + "\n")
+        self.assertEqual(symlink_picture_list.load_filelists([self.filelist]),
+                         {self.filelist: [existing]})
+
+
+if __name__ == "__main__":
+    unittest.main()
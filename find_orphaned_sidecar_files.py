@@ -28,10 +28,22 @@ Find sidecar files (like XMP) which don't have the associated base file anymore"
 
 # Standard library imports:
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import csv
+import errno
+import io
+import json
 import os
 import logging
+import shutil
+import sqlite3
 import sys
-from typing import List, Generator
+import time
+import xml.parsers.expat
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
 
 
 # list of file extensions, all lowercase, without leading "."
@@ -40,13 +52,37 @@ DEFAULT_SIDECAR_EXTENSIONS = [
     "pp3"
 ]
 
+# file name of the manifest in the quarantine folder
+MANIFEST_NAME = "manifest.jsonl"
+
+# supported output formats, see ResultWriter
+OUTPUT_FORMATS = ["plain", "null", "jsonl", "csv"]
+
+# result categories:
+# orphaned: sidecar file without base file
+# missing: base file without any sidecar file
+# duplicate: one of several sidecar files with the same extension for a base file
+CATEGORY_ORPHANED = "orphaned"
+CATEGORY_MISSING = "missing"
+CATEGORY_DUPLICATE = "duplicate"
+CATEGORIES = [CATEGORY_ORPHANED, CATEGORY_MISSING, CATEGORY_DUPLICATE]
+
+# XMP properties which reference the original file, as expat namespace URI and
+# local name joined by a space
+XMP_NAMESPACE_CRS = "http://ns.adobe.com/camera-raw-settings/1.0/"
+XMP_NAMESPACE_XMPMM = "http://ns.adobe.com/xap/1.0/mm/"
+XMP_NAMESPACE_STREF = "http://ns.adobe.com/xap/1.0/sType/ResourceRef#"
+XMP_RAW_FILE_NAME = XMP_NAMESPACE_CRS + " RawFileName"
+XMP_DERIVED_FROM = XMP_NAMESPACE_XMPMM + " DerivedFrom"
+XMP_FILE_PATH = XMP_NAMESPACE_STREF + " filePath"
+
 def get_args(args):
     '''Configures command line parser and returns parsed parameters'''
     parser = argparse.ArgumentParser(
         description="""Find sidecar files (like XMP) which don't
         have the associated base file anymore""")
     parser.add_argument(
-        "base_folder",
+        "base_folder", nargs="?",
         help="Base folder to recursively search for orphaned sidecar files")
     parser.add_argument(
         "-d", "--debug", dest="debuglevel", action="store_const",
@@ -57,10 +93,72 @@ def get_args(args):
         default=DEFAULT_SIDECAR_EXTENSIONS,
         help="Comma seperated list of sidecar file extensions. Defaults to \"{}\"".format(
             ",".join(DEFAULT_SIDECAR_EXTENSIONS)))
-    return parser.parse_args(args)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of folders listed in parallel, e.g. for network filesystems. "
+        "Defaults to 1")
+    parser.add_argument(
+        "-s", "--sorted", action="store_true",
+        help="Output results in sorted folder and file order")
+    parser.add_argument(
+        "-r", "--report", type=lambda x: x.lower().split(","),
+        default=[CATEGORY_ORPHANED],
+        help="Comma separated list of what to report: orphaned sidecar files (orphaned), "
+        "base files without sidecar file (missing) and competing sidecar files with the "
+        "same extension for one base file (duplicate). With more than one category each "
+        "output line is prefixed by its category. Defaults to \"{}\"".format(CATEGORY_ORPHANED))
+    parser.add_argument(
+        "-o", "--original-extensions", type=lambda x: x.lower().split(","),
+        help="Comma separated list of base file extensions considered for \"missing\", "
+        "e.g. \"cr2,nef\". Defaults to all files which are not sidecar files")
+    parser.add_argument(
+        "-c", "--cache",
+        help="SQLite file to cache results of unchanged folders between runs")
+    parser.add_argument(
+        "--rebuild-cache", action="store_true",
+        help="Ignore the current content of the cache file and build it from scratch")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument(
+        "-q", "--quarantine", metavar="DIR",
+        help="Move orphaned files to DIR, keeping their path relative to base_folder. "
+        "The moves are appended to DIR/{}".format(MANIFEST_NAME))
+    action.add_argument(
+        "--delete", action="store_true",
+        help="Delete orphaned files")
+    action.add_argument(
+        "--restore", metavar="MANIFEST",
+        help="Move files listed in a quarantine manifest back to their original place")
+    parser.add_argument(
+        "-f", "--format", choices=OUTPUT_FORMATS, default="plain",
+        help="Output format: one path per line (plain), NUL terminated paths e.g. for "
+        "\"xargs -0\" (null), JSON lines with path, size and mtime (jsonl) or CSV with "
+        "the same columns (csv). Defaults to plain")
+    parser.add_argument(
+        "--reattach", action="store_true",
+        help="Read crs:RawFileName and xmpMM:DerivedFrom of orphaned XMP files, search "
+        "files with that name below base_folder and output them as proposed new base file")
+    parsed = parser.parse_args(args)
+    if not parsed.restore and not parsed.base_folder:
+        parser.error("base_folder is required")
+    for category in parsed.report:
+        if category not in CATEGORIES:
+            parser.error("unknown report category {}".format(category))
+    if (parsed.quarantine or parsed.delete) and parsed.report != [CATEGORY_ORPHANED]:
+        parser.error("--quarantine and --delete can only be used for orphaned files")
+    if parsed.reattach and (parsed.report != [CATEGORY_ORPHANED] or parsed.cache
+                            or parsed.quarantine or parsed.delete):
+        parser.error("--reattach cannot be combined with --report, --cache, "
+                     "--quarantine and --delete")
+    if parsed.quarantine:
+        quarantine = os.path.abspath(parsed.quarantine)
+        base_folder = os.path.abspath(parsed.base_folder)
+        if os.path.commonpath([quarantine, base_folder]) == base_folder:
+            parser.error("quarantine folder must not be inside base_folder")
+    return parsed
 
 
-def get_orphaned_files(files_in_folder: List[str], sidecar_extensions: List[str]) -> List[str]:
+def get_orphaned_files(files_in_folder: Iterable[str],
+                       sidecar_extensions: Iterable[str]) -> List[str]:
     '''Returns orphaned files from a specific folder
 
     In the following example both abc.def.xyz and abc.def are considered as sidecar
@@ -77,57 +175,754 @@ def get_orphaned_files(files_in_folder: List[str], sidecar_extensions: List[str]
 
     Returns:
 
-    List of orphaned files
+    List of orphaned files, in the order they appear in files_in_folder
+
+    Lookups are done in sets and dicts, so the runtime grows linearly with the
+    number of files in the folder.
     '''
 
-    result = []
-    sidecar_files = [] # list of sidecar only files
-    orig_files_base = [] # original file names, no sidecar files
+    return [entry for _, entry in classify_files(files_in_folder, sidecar_extensions)]
+
+
+def classify_files(files_in_folder: Iterable[str], sidecar_extensions: Iterable[str],
+                   categories: Iterable[str] = (CATEGORY_ORPHANED,),
+                   original_extensions: Optional[Iterable[str]] = None) -> List[Tuple[str, str]]:
+    '''Classifies the files of a specific folder in a single pass
+
+    Builds an index which maps every base file to its sidecar files, with the
+    same matching rules as get_orphaned_files: abc.def.xyz and abc.xyz are
+    both sidecar files of abc.def.
+
+    Arguments:
+
+    files_in_folder: List of filenames in folders
+    sidecar_extensions: List of sidecar file extensions
+    categories: Categories to report, see CATEGORIES
+    original_extensions: Extensions of base files reported as CATEGORY_MISSING,
+                         None for all files which are not sidecar files
+
+    Returns:
+
+    List of (category, filename) tuples. Orphans come first in the order of
+    files_in_folder, then missing base files and duplicate sidecar files in
+    sorted order.
+    '''
+
+    sidecar_extensions = frozenset(sidecar_extensions)
+    categories = frozenset(categories)
+    sidecar_files = [] # (sidecar file, base, extension)
+    originals = set()
+    originals_by_stem: Dict[str, List[str]] = {} # abc -> [abc.def, abc.ghi]
 
     for entry in files_in_folder:
         base, ext = os.path.splitext(entry)
-        if ext.lower().lstrip(".") in sidecar_extensions:
-            sidecar_files.append(entry)
+        ext = ext.lower().lstrip(".")
+        if ext in sidecar_extensions:
+            sidecar_files.append((entry, base, ext))
         else:
+            originals.add(entry)
+            originals_by_stem.setdefault(base, []).append(entry)
+
+    result = []
+    index: Dict[str, List[Tuple[str, str]]] = {} # base file -> [(sidecar, extension)]
+    for entry, base, ext in sidecar_files:
+        matched = False
+        if base in originals:
             # Match for abc.def
-            orig_files_base.append(entry)
+            index.setdefault(base, []).append((entry, ext))
+            matched = True
+        for original in originals_by_stem.get(base, ()):
             # Match for abc.xyz
-            orig_files_base.append(base)
+            if original != base:
+                index.setdefault(original, []).append((entry, ext))
+                matched = True
+        if not matched and CATEGORY_ORPHANED in categories:
+            result.append((CATEGORY_ORPHANED, entry))
 
-    for entry in sidecar_files:
-        base, ext = os.path.splitext(entry)
-        if not base in orig_files_base:
-            result.append(entry)
+    if CATEGORY_MISSING in categories:
+        if original_extensions is not None:
+            original_extensions = frozenset(original_extensions)
+        for original in sorted(originals):
+            if original in index:
+                continue
+            ext = os.path.splitext(original)[1].lower().lstrip(".")
+            if original_extensions is None or ext in original_extensions:
+                result.append((CATEGORY_MISSING, original))
+
+    if CATEGORY_DUPLICATE in categories:
+        duplicates = set()
+        for sidecars in index.values():
+            by_ext: Dict[str, List[str]] = {}
+            for entry, ext in sidecars:
+                by_ext.setdefault(ext, []).append(entry)
+            for entries in by_ext.values():
+                if len(entries) > 1:
+                    duplicates.update(entries)
+        result.extend((CATEGORY_DUPLICATE, entry) for entry in sorted(duplicates))
 
     return result
 
 
-def find_files(base_folder: str, sidecar_extensions) -> Generator[str, None, None]:
-    '''Find sidecar files
+class FilenameIndex:
+    '''Memory compact index of file names to the folders containing them
+
+    Folder paths are stored once. File names are interned and, after
+    finalize(), kept in a sorted list together with an array of folder
+    numbers, so lookups use bisect and no per file tuples or dicts are needed.
+    '''
+
+    def __init__(self):
+        self.folders: List[str] = []
+        self.names: List[str] = []
+        self.folder_numbers = array.array("I")
+        self.sorted = True
+
+    def add_folder(self, folder: str, files: Iterable[str]):
+        '''Adds the files of a folder'''
+        number = len(self.folders)
+        self.folders.append(folder)
+        for file_ in files:
+            self.names.append(sys.intern(file_))
+            self.folder_numbers.append(number)
+        self.sorted = False
+
+    def finalize(self):
+        '''Sorts the index, needs to be called after the last add_folder'''
+        if self.sorted:
+            return
+        order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        self.names = [self.names[i] for i in order]
+        self.folder_numbers = array.array("I", (self.folder_numbers[i] for i in order))
+        self.sorted = True
+
+    def lookup(self, name: str) -> List[str]:
+        '''Returns the full paths of all files with the given name'''
+        self.finalize()
+        start = bisect.bisect_left(self.names, name)
+        end = bisect.bisect_right(self.names, name, start)
+        return [os.path.join(self.folders[self.folder_numbers[i]], name)
+                for i in range(start, end)]
+
+
+# Result of listing a single folder. files is None if the folder is unchanged
+# according to the cache. dir_ids contains (st_dev, st_ino) for every entry in
+# dirs, mtime_ns is only set if a cache is used.
+FolderListing = collections.namedtuple(
+    "FolderListing", ["root", "dirs", "files", "dir_ids", "mtime_ns"])
+
+# Cached state of a single folder
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["mtime_ns", "dirs", "dir_ids", "results"])
+
+
+class OrphanCache:
+    '''Persistent cache of the classify_files results per folder, stored in SQLite
+
+    A folder's mtime changes whenever an entry is added, removed or renamed in
+    it. If the mtime is still the same as in the last run the folder does not
+    need to be listed again, the cached subfolders and results are used instead.
+
+    The whole cache is kept in memory during the run and written back by save().
+    It is only valid for the same base folder, sidecar extensions and report
+    settings, otherwise it starts empty.
+    '''
+
+    def __init__(self, filename: str, base_folder: str, sidecar_extensions: Iterable[str],
+                 rebuild: bool = False, categories: Iterable[str] = (CATEGORY_ORPHANED,),
+                 original_extensions: Optional[Iterable[str]] = None):
+        self.filename = filename
+        self.settings = {
+            "base_folder": os.path.abspath(base_folder),
+            "extensions": ",".join(sorted(set(sidecar_extensions))),
+            "categories": ",".join(sorted(set(categories))),
+            "original_extensions": ",".join(sorted(set(original_extensions)))
+                                   if original_extensions is not None else "*"
+        }
+        self.old_entries: Dict[str, CacheEntry] = {}
+        self.new_entries: Dict[str, CacheEntry] = {}
+        self.hits = 0
+        self.misses = 0
+        if not rebuild and os.path.exists(filename):
+            self._load()
+
+    def _load(self):
+        '''Loads the cache file, ignores it if it belongs to another configuration'''
+        try:
+            connection = sqlite3.connect(self.filename)
+            try:
+                settings = dict(connection.execute("SELECT key, value FROM settings"))
+                if settings != self.settings:
+                    logging.info("Cache %s was built with other settings, ignoring it",
+                                 self.filename)
+                    return
+                for path, mtime_ns, dirs, dir_ids, results in connection.execute(
+                        "SELECT path, mtime_ns, dirs, dir_ids, results FROM folders"):
+                    self.old_entries[path] = CacheEntry(
+                        mtime_ns, json.loads(dirs),
+                        [tuple(dir_id) for dir_id in json.loads(dir_ids)],
+                        [tuple(result) for result in json.loads(results)])
+            finally:
+                connection.close()
+        except sqlite3.Error as error:
+            logging.warning("Cannot read cache %s: %s", self.filename, error)
+            self.old_entries = {}
+
+    def lookup(self, path: str, mtime_ns: int) -> Optional[CacheEntry]:
+        '''Returns the cached entry if the folder is unchanged, None otherwise
+
+        Can be called from several threads.'''
+        entry = self.old_entries.get(path)
+        if entry is not None and entry.mtime_ns == mtime_ns:
+            return entry
+        return None
+
+    def get_results(self, path: str) -> List[Tuple[str, str]]:
+        '''Returns the results of an unchanged folder and marks it as visited'''
+        entry = self.old_entries[path]
+        self.new_entries[path] = entry
+        self.hits += 1
+        return entry.results
+
+    def update(self, listing: FolderListing, results: List[Tuple[str, str]]):
+        '''Stores the results of a freshly listed folder'''
+        self.new_entries[listing.root] = CacheEntry(
+            listing.mtime_ns, listing.dirs, listing.dir_ids, results)
+        self.misses += 1
+
+    def hit_rate(self) -> float:
+        '''Returns the share of folders taken from the cache, between 0 and 1'''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def save(self):
+        '''Writes all folders visited in this run to the cache file
+
+        Folders which were not visited anymore are dropped.'''
+        connection = sqlite3.connect(self.filename)
+        try:
+            with connection:
+                connection.execute("DROP TABLE IF EXISTS settings")
+                connection.execute("DROP TABLE IF EXISTS folders")
+                connection.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+                connection.execute(
+                    "CREATE TABLE folders (path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                    "dirs TEXT, dir_ids TEXT, results TEXT)")
+                connection.executemany(
+                    "INSERT INTO settings VALUES (?, ?)", self.settings.items())
+                connection.executemany(
+                    "INSERT INTO folders VALUES (?, ?, ?, ?, ?)",
+                    ((path, entry.mtime_ns, json.dumps(entry.dirs), json.dumps(entry.dir_ids),
+                      json.dumps(entry.results))
+                     for path, entry in self.new_entries.items()))
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+
+def list_folder(folder: str, cache: Optional[OrphanCache] = None) -> FolderListing:
+    '''Lists a single folder with os.scandir
+
+    Symlinks to folders are treated as folders.
+
+    Arguments:
+
+    folder: The folder to list
+    cache: If given and the folder is unchanged, the cached subfolders are
+           returned and files is None
+
+    Returns a FolderListing
+    '''
+
+    mtime_ns = None
+    if cache is not None:
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+        except OSError as error:
+            logging.warning("Cannot access %s: %s", folder, error)
+            return FolderListing(folder, [], [], [], None)
+        entry = cache.lookup(folder, mtime_ns)
+        if entry is not None:
+            return FolderListing(folder, list(entry.dirs), None, list(entry.dir_ids), mtime_ns)
+
+    dirs = []
+    files = []
+    dir_ids = []
+    try:
+        with os.scandir(folder) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir():
+                        stat = entry.stat()
+                        dirs.append(entry.name)
+                        dir_ids.append((stat.st_dev, stat.st_ino))
+                    else:
+                        files.append(entry.name)
+                except OSError:
+                    # e.g. dangling symlink or no permission, os.walk treats
+                    # them as files as well
+                    files.append(entry.name)
+    except OSError as error:
+        logging.warning("Cannot list %s: %s", folder, error)
+    return FolderListing(folder, dirs, files, dir_ids, mtime_ns)
+
+
+def walk_parallel(base_folder: str, jobs: int, sort: bool = False,
+                  cache: Optional[OrphanCache] = None) -> Generator[FolderListing, None, None]:
+    '''Walks the folder tree like os.walk(followlinks=True), listing folders in parallel
+
+    Every folder is listed with os.scandir in a thread pool. Folders which
+    were already visited (same st_dev and st_ino) are skipped, so symlink
+    loops do not lead to endless recursion.
+
+    Arguments:
+
+    base_folder: The base folder where to start the recursive search
+    jobs: Number of folders listed concurrently
+    sort: Yield folders in the same order as a sorted top down os.walk and sort
+          the dirs and files lists. Otherwise folders are yielded as soon as
+          they are listed.
+    cache: Passed on to list_folder
+
+    Returns a FolderListing per folder (yield)
+    '''
+
+    try:
+        stat = os.stat(base_folder)
+    except OSError as error:
+        logging.warning("Cannot access %s: %s", base_folder, error)
+        return
+    visited = {(stat.st_dev, stat.st_ino)}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit_children(listing):
+            '''Submits not yet visited subfolders, returns list of futures'''
+            futures = []
+            for dir_, dir_id in zip(listing.dirs, listing.dir_ids):
+                path = os.path.join(listing.root, dir_)
+                if dir_id in visited:
+                    logging.debug("Skipping already visited folder %s", path)
+                    continue
+                visited.add(dir_id)
+                futures.append(executor.submit(list_folder, path, cache))
+            return futures
+
+        root_future = executor.submit(list_folder, base_folder, cache)
+
+        if sort:
+            # Depth first, in sorted order. Children of a folder are listed
+            # concurrently while the parent is processed.
+            stack = [root_future]
+            while stack:
+                listing = stack.pop().result()
+                ordered = sorted(zip(listing.dirs, listing.dir_ids))
+                listing = listing._replace(
+                    dirs=[dir_ for dir_, _ in ordered],
+                    dir_ids=[dir_id for _, dir_id in ordered],
+                    files=sorted(listing.files) if listing.files is not None else None)
+                yield listing
+                stack.extend(reversed(submit_children(listing)))
+        else:
+            pending = {root_future}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    listing = future.result()
+                    yield listing
+                    pending.update(submit_children(listing))
+
+
+def find_entries(base_folder: str, sidecar_extensions, jobs: int = 1, sort: bool = False,
+                 cache: Optional[OrphanCache] = None,
+                 categories: Iterable[str] = (CATEGORY_ORPHANED,),
+                 original_extensions: Optional[Iterable[str]] = None,
+                 file_index: Optional[FilenameIndex] = None
+                ) -> Generator[Tuple[str, str], None, None]:
+    '''Find orphaned sidecar files, base files without sidecar and duplicate sidecars
 
     Arguments:
 
     base_folder: The base folder where to start the recursive search
     sidecar_extensions: List of sidecar file extensions
+    jobs: Number of folders listed concurrently, 1 uses a plain os.walk
+    sort: Search folders and files in sorted order
+    cache: Skips folders which are unchanged since the last run and takes
+           the results from the cache instead. Call cache.save() after the
+           generator is exhausted.
+    categories, original_extensions: see classify_files
+    file_index: If given, all files which are not sidecar files are added to it.
+                Cannot be used together with cache.
+
+    Returns (category, path) tuples (yield)
+    '''
+
+    if jobs > 1 or cache is not None:
+        walker = walk_parallel(base_folder, jobs, sort, cache)
+    else:
+        walker = (FolderListing(root, dirs, files, None, None)
+                  for root, dirs, files in os.walk(base_folder, followlinks=True))
+
+    for listing in walker:
+        if listing.files is None:
+            results = cache.get_results(listing.root)
+            if sort:
+                results = sorted(results, key=lambda x: (CATEGORIES.index(x[0]), x[1]))
+        else:
+            files = listing.files
+            if sort and listing.dir_ids is None:
+                listing.dirs.sort()
+                files = sorted(files)
+            results = []
+            if files:
+                logging.debug("Checking %s with %d files", listing.root, len(files))
+                results = classify_files(files, sidecar_extensions, categories,
+                                         original_extensions)
+            if cache is not None:
+                cache.update(listing, results)
+            if file_index is not None:
+                file_index.add_folder(listing.root, (
+                    file_ for file_ in files
+                    if os.path.splitext(file_)[1].lower().lstrip(".") not in sidecar_extensions))
+        for category, file_ in results:
+            yield category, os.path.join(listing.root, file_)
+
+
+def find_files(base_folder: str, sidecar_extensions, jobs: int = 1, sort: bool = False,
+               cache: Optional[OrphanCache] = None) -> Generator[str, None, None]:
+    '''Find sidecar files
+
+    Arguments: see find_entries
 
     Returns a list of duplicates (yield)
     '''
 
-    for root, _, files in os.walk(base_folder, followlinks=True):
-        if files:
-            logging.debug("Checking %s with %d files", root, len(files))
-            orphaned_files = get_orphaned_files(files, sidecar_extensions)
-            if orphaned_files:
-                for file_ in orphaned_files:
-                    yield os.path.join(root, file_)
+    for _, path in find_entries(base_folder, sidecar_extensions, jobs, sort, cache):
+        yield path
+
+
+def get_xmp_references(filename: str) -> List[str]:
+    '''Returns the file names referenced by crs:RawFileName and xmpMM:DerivedFrom
+
+    The XMP file is parsed with expat in a streaming way. For
+    crs:RawFileName both the attribute form (crs:RawFileName="abc.cr2") and
+    the element form are supported, for xmpMM:DerivedFrom the stRef:filePath
+    of the resource reference, again as attribute or as element.
+    Paths are reduced to the file name. Returns an empty list if the file
+    cannot be parsed.
+    '''
+
+    result = []
+    # Workaround to allow write access to variables from inner functions
+    in_element = [None]
+    text = []
+    in_derived_from = [0]
+
+    def add(value):
+        '''adds a referenced file name'''
+        name = value.strip().replace("\\", "/").rsplit("/", 1)[-1]
+        if name and name not in result:
+            result.append(name)
+
+    def cb_start_element(name, attrs):
+        '''expat callback'''
+        if name == XMP_DERIVED_FROM:
+            in_derived_from[0] += 1
+        for attr in (XMP_RAW_FILE_NAME, XMP_DERIVED_FROM):
+            if attr in attrs:
+                add(attrs[attr])
+        if in_derived_from[0] and XMP_FILE_PATH in attrs:
+            add(attrs[XMP_FILE_PATH])
+        if name == XMP_RAW_FILE_NAME or (in_derived_from[0] and name == XMP_FILE_PATH):
+            in_element[0] = name
+            del text[:]
+
+    def cb_end_element(name):
+        '''expat callback'''
+        if name == in_element[0]:
+            add("".join(text))
+            in_element[0] = None
+        if name == XMP_DERIVED_FROM:
+            in_derived_from[0] -= 1
+
+    def cb_character_data(data):
+        '''expat callback'''
+        if in_element[0] is not None:
+            text.append(data)
+
+    try:
+        with open(filename, "rb") as filehandle:
+            parser = xml.parsers.expat.ParserCreate(namespace_separator=" ")
+            parser.StartElementHandler = cb_start_element
+            parser.EndElementHandler = cb_end_element
+            parser.CharacterDataHandler = cb_character_data
+            parser.ParseFile(filehandle)
+    except (OSError, xml.parsers.expat.ExpatError) as error:
+        logging.warning("Cannot parse %s: %s", filename, error)
+    return result
+
+
+def propose_reattachments(orphans: Iterable[str], file_index: FilenameIndex
+                         ) -> Generator[Tuple[str, List[str]], None, None]:
+    '''Proposes new base files for orphaned sidecar files
+
+    For XMP files the references returned by get_xmp_references are searched
+    in file_index. If there are none, the name of the sidecar file without
+    its extension is searched instead (abc.def for abc.def.xmp).
+
+    Returns (orphan, list of proposed base files) tuples (yield)
+    '''
+
+    for orphan in orphans:
+        names = []
+        if orphan.lower().endswith(".xmp"):
+            names = get_xmp_references(orphan)
+        if not names:
+            base = os.path.splitext(os.path.basename(orphan))[0]
+            if os.path.splitext(base)[1]:
+                names = [base]
+        candidates = []
+        for name in names:
+            candidates.extend(file_index.lookup(name))
+        yield orphan, candidates
+
+
+def move_file(source: str, target: str):
+    '''Moves source to target, creating missing parent folders of target
+
+    A rename is used if both are on the same filesystem. Otherwise the file is
+    copied to a temporary name next to target, renamed to target and the
+    source is removed afterwards, so target never exists half written.
+
+    Raises FileExistsError if target already exists.
+    '''
+
+    if os.path.lexists(target):
+        raise FileExistsError(errno.EEXIST, "Target already exists", target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.rename(source, target)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        tmp_target = target + ".tmp%d" % os.getpid()
+        shutil.copy2(source, tmp_target)
+        os.rename(tmp_target, target)
+        os.remove(source)
+
+
+def quarantine_files(files: Iterable[str], base_folder: str,
+                     quarantine_folder: str) -> Generator[str, None, None]:
+    '''Moves files to quarantine_folder and records them in its manifest
+
+    Every file keeps its path relative to base_folder inside quarantine_folder.
+    For every moved file a JSON line {"source": ..., "target": ...} with
+    absolute paths is appended to the manifest and flushed, so the manifest
+    stays usable even if the run is interrupted.
+
+    Returns the successfully moved files (yield)
+    '''
+
+    base_folder = os.path.abspath(base_folder)
+    quarantine_folder = os.path.abspath(quarantine_folder)
+    os.makedirs(quarantine_folder, exist_ok=True)
+    with open(os.path.join(quarantine_folder, MANIFEST_NAME), "a") as manifest:
+        for file_ in files:
+            source = os.path.abspath(file_)
+            target = os.path.join(quarantine_folder, os.path.relpath(source, base_folder))
+            try:
+                move_file(source, target)
+            except OSError as error:
+                logging.warning("Cannot move %s to quarantine: %s", file_, error)
+                continue
+            manifest.write(json.dumps({"source": source, "target": target}) + "\n")
+            manifest.flush()
+            yield file_
+
+
+def delete_files(files: Iterable[str]) -> Generator[str, None, None]:
+    '''Deletes files
+
+    Returns the successfully deleted files (yield)
+    '''
+
+    for file_ in files:
+        try:
+            os.remove(file_)
+        except OSError as error:
+            logging.warning("Cannot delete %s: %s", file_, error)
+            continue
+        yield file_
+
+
+def restore_files(manifest_file: str) -> Generator[str, None, None]:
+    '''Moves files recorded by quarantine_files back to their original place
+
+    Entries whose quarantined file is gone (e.g. already restored) are skipped.
+
+    Returns the restored files (yield)
+    '''
+
+    with open(manifest_file, "r") as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not os.path.lexists(entry["target"]):
+                logging.debug("%s not in quarantine anymore. Skip", entry["target"])
+                continue
+            try:
+                move_file(entry["target"], entry["source"])
+            except OSError as error:
+                logging.warning("Cannot restore %s: %s", entry["source"], error)
+                continue
+            yield entry["source"]
+
+
+class ResultWriter:
+    '''Writes result paths to a binary stream in one of OUTPUT_FORMATS
+
+    Output is collected in a large buffer and flushed every chunk_size
+    entries or when an entry is written flush_interval seconds after the last
+    flush, so consumers get the results in chunks while the search is still
+    running, even if results are rare. Paths which are not valid in the filesystem encoding are written
+    as the original bytes.
+
+    If categorised is set, plain and null output is prefixed by the category
+    and a tab. jsonl and csv output always contains the category.
+
+    If an original is given (proposed base file for --reattach) it is appended
+    to plain and null output, separated by a tab.
+    '''
+
+    def __init__(self, stream, output_format: str = "plain", chunk_size: int = 1000,
+                 categorised: bool = False, flush_interval: float = 1.0):
+        self.output_format = output_format
+        self.categorised = categorised
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.stream = io.TextIOWrapper(
+            stream, encoding=sys.getfilesystemencoding(), errors="surrogateescape",
+            newline="", write_through=False)
+        self.csv_writer = None
+        if output_format == "csv":
+            self.csv_writer = csv.writer(self.stream, lineterminator="\n")
+            self.csv_writer.writerow(["category", "path", "size", "mtime", "original"])
+
+    def needs_stat(self) -> bool:
+        '''Returns True if the format contains size and mtime'''
+        return self.output_format in ("jsonl", "csv")
+
+    def write(self, path: str, stat: Optional[os.stat_result] = None,
+              category: str = CATEGORY_ORPHANED, original: Optional[str] = None):
+        '''Writes a single path
+
+        stat is used for size and mtime, if not given the path is stat'ed.'''
+        if self.needs_stat() and stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError as error:
+                logging.warning("Cannot stat %s: %s", path, error)
+        size = stat.st_size if stat is not None else None
+        mtime = stat.st_mtime if stat is not None else None
+
+        prefix = category + "\t" if self.categorised else ""
+        suffix = "\t" + original if original is not None else ""
+        if self.output_format == "null":
+            self.stream.write(prefix + path + suffix + "\0")
+        elif self.output_format == "jsonl":
+            record = {"category": category, "path": path, "size": size, "mtime": mtime}
+            if original is not None:
+                record["original"] = original
+            self.stream.write(json.dumps(record) + "\n")
+        elif self.csv_writer is not None:
+            self.csv_writer.writerow([category, path, size, mtime, original])
+        else:
+            self.stream.write(prefix + path + suffix + "\n")
+
+        self.pending += 1
+        if self.pending >= self.chunk_size or \
+                time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Flushes all pending output'''
+        self.stream.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        '''Flushes all pending output, the underlying stream stays open'''
+        self.flush()
+        self.stream.detach()
+
+
+def stat_files(files: Iterable[str],
+               stats: Dict[str, os.stat_result]) -> Generator[str, None, None]:
+    '''Stats files and stores the result in stats, e.g. before they are moved
+
+    Returns files (yield)
+    '''
+
+    for file_ in files:
+        try:
+            stats[file_] = os.stat(file_)
+        except OSError as error:
+            logging.warning("Cannot stat %s: %s", file_, error)
+        yield file_
 
 
 def main():
     '''main function, called when script file is executed directly'''
     args = get_args(sys.argv[1:])
     logging.basicConfig(format="%(message)s", level=args.debuglevel)
-    for entry in find_files(args.base_folder, args.extensions):
-        print(entry)
+
+    writer = ResultWriter(sys.stdout.buffer, args.format,
+                          categorised=len(args.report) > 1)
+
+    if args.restore:
+        for entry in restore_files(args.restore):
+            writer.write(entry)
+        writer.close()
+        return
+
+    cache = None
+    if args.cache:
+        cache = OrphanCache(args.cache, args.base_folder, args.extensions, args.rebuild_cache,
+                            args.report, args.original_extensions)
+    file_index = FilenameIndex() if args.reattach else None
+    entries = find_entries(args.base_folder, args.extensions, args.jobs, args.sorted, cache,
+                           args.report, args.original_extensions, file_index)
+    if file_index is not None:
+        # The whole tree needs to be indexed before the first proposal
+        orphans = [path for _, path in entries]
+        file_index.finalize()
+        for orphan, candidates in propose_reattachments(orphans, file_index):
+            if not candidates:
+                writer.write(orphan)
+            for candidate in candidates:
+                writer.write(orphan, original=candidate)
+    elif args.quarantine or args.delete:
+        files = (path for _, path in entries)
+        stats = {}
+        if writer.needs_stat():
+            files = stat_files(files, stats)
+        if args.quarantine:
+            files = quarantine_files(files, args.base_folder, args.quarantine)
+        else:
+            files = delete_files(files)
+        for entry in files:
+            writer.write(entry, stats.pop(entry, None))
+    else:
+        for category, entry in entries:
+            writer.write(entry, category=category)
+    writer.close()
+    if cache is not None:
+        cache.save()
+        logging.info("Cache hit rate: %.1f%% (%d of %d folders)",
+                     cache.hit_rate() * 100, cache.hits, cache.hits + cache.misses)
 
 
 if __name__ == "__main__":
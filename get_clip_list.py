@@ -27,16 +27,45 @@
 
 # Standard library imports:
 import argparse
+import asyncio
+import collections
 import csv
+import ctypes
+import ctypes.util
 import datetime
 import distutils.spawn
+import hashlib
 import json
 import logging
+import mmap
 import os
+import select
+import sqlite3
+import struct
 import subprocess
 import sys
+import threading
+import time
 
 
+# Available columns, see get_clip_info
+COLUMNS = [
+    "filename", "size_mb", "duration_s", "timestamp",
+    "codec", "width", "height", "fps", "bitrate", "pix_fmt", "container",
+    "audio_codec", "audio_channels", "audio_sample_rate", "audio_streams", "error",
+    "duplicate_of"
+]
+DEFAULT_COLUMNS = ["filename", "size_mb", "duration_s", "timestamp", "error"]
+
+# Default time in seconds after which ffprobe is killed
+FFPROBE_TIMEOUT = 15
+
+# Extensions of video files, all lowercase with leading "."
+VIDEO_EXTENSIONS = [
+    ".3gp", ".avi", ".flv", ".m2t", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg",
+    ".mpg", ".mts", ".mxf", ".ogv", ".ts", ".vob", ".webm", ".wmv"
+]
+
 def get_args():
     '''Configures command line parser and returns parsed parameters'''
     parser = argparse.ArgumentParser(
@@ -46,50 +75,553 @@ def get_args():
         help="Folder name of video clips.")
     parser.add_argument(
         "csvfile",
-        help="File name of the CSV file, will be overwritten if existent.")
+        help="File name of the CSV (or JSON Lines) file, will be overwritten if existent.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of ffprobe processes running in parallel. Defaults to 1.")
+    parser.add_argument(
+        "-t", "--timeout", type=float, default=FFPROBE_TIMEOUT,
+        help="Time in seconds after which ffprobe is killed and the file is recorded "
+        "with error \"timeout\". Defaults to %(default)s.")
+    parser.add_argument(
+        "--cache", default=get_default_cache_file(),
+        help="SQLite file caching ffprobe results by path, size and mtime. "
+        "Defaults to %(default)s.")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Neither read nor write the ffprobe cache.")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="Keep the rows of an existing (partial) CSV file and only append rows "
+        "for files not listed in it yet.")
+    parser.add_argument(
+        "--fast", action="store_true",
+        help="Only read duration and creation time: MP4/MOV files are parsed directly, "
+        "ffprobe reads as little data as possible for the other files. Other columns "
+        "are N/A then.")
+    parser.add_argument(
+        "--no-prefilter", action="store_true",
+        help="Probe all files. By default files without a known video extension are "
+        "only probed if their first bytes look like a video file.")
+    parser.add_argument(
+        "-w", "--watch", action="store_true",
+        help="After the initial run keep watching folder (Linux inotify) and append "
+        "rows for new video files once they are completely written. Implies --resume.")
+    parser.add_argument(
+        "--debounce", type=float, default=5,
+        help="Seconds a new file must stay unchanged before it is probed in --watch "
+        "mode. Defaults to %(default)s.")
+    parser.add_argument(
+        "-s", "--summary", metavar="FILE",
+        help="Additionally write totals (clips, duration, size, first and last timestamp) "
+        "of the clips probed in this run to FILE. JSON if FILE ends with .json, "
+        "CSV otherwise.")
+    parser.add_argument(
+        "--summary-by", choices=["date", "folder"], default="date",
+        help="Group the summary by date of the timestamp or by subfolder. "
+        "Defaults to %(default)s.")
+    parser.add_argument(
+        "--find-duplicates", action="store_true",
+        help="Compare clips with the same size and duration by content and write the "
+        "first identical clip to the duplicate_of column.")
+    parser.add_argument(
+        "-c", "--columns", type=lambda x: x.split(","), default=DEFAULT_COLUMNS,
+        help="Comma separated list of columns, available are {}. Defaults to {}.".format(
+            ",".join(COLUMNS), ",".join(DEFAULT_COLUMNS)))
+    parser.add_argument(
+        "-f", "--format", choices=["csv", "jsonl"], default="csv",
+        help="Output format, CSV or JSON Lines. Defaults to csv.")
+
+    args = parser.parse_args()
+    if args.find_duplicates and "duplicate_of" not in args.columns:
+        args.columns = args.columns + ["duplicate_of"]
+    for column in args.columns:
+        if column not in COLUMNS:
+            parser.error("unknown column {}".format(column))
+    return args
+
+
+def get_default_cache_file():
+    '''Returns the default cache file name below XDG_CACHE_HOME'''
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "get_clip_list", "ffprobe_cache.sqlite")
+
 
-    return parser.parse_args()
+# Packet sizes of MPEG transport streams, M2TS packets have a 4 byte prefix
+TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = 192
 
 
-def get_file_list(folder):
-    '''Returns a sorted filelist of the given folder'''
+def is_video_file(filename):
+    '''Returns True if filename looks like a video file
 
-    result = []
-    for (dirpath, _, filenames) in os.walk(folder):
-        result.extend(
-            [os.path.join(dirpath, filename) for filename in filenames])
-    return result
+    Files with an extension in VIDEO_EXTENSIONS are accepted right away. For
+    all others the start of the file is checked for the magic numbers of ISO
+    base media files (ftyp), MPEG transport streams (sync bytes of the first
+    two 188 byte packets, or 192 byte packets with the M2TS prefix),
+    Matroska/WebM (EBML), MPEG program streams, AVI and ASF/WMV.'''
+    if os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS:
+        return True
+    try:
+        with open(filename, "rb") as file_:
+            header = file_.read(2 * M2TS_PACKET_SIZE)
+    except OSError:
+        return False
+    return (header[4:8] == b"ftyp" or
+            header[0:1] == header[TS_PACKET_SIZE:TS_PACKET_SIZE + 1] == b"\x47" or
+            header[4:5] == header[M2TS_PACKET_SIZE + 4:M2TS_PACKET_SIZE + 5] == b"\x47" or
+            header[:4] == b"\x1a\x45\xdf\xa3" or
+            header[:4] == b"\x00\x00\x01\xba" or
+            (header[:4] == b"RIFF" and header[8:12] == b"AVI ") or
+            header[:4] == b"\x30\x26\xb2\x75")
 
 
-def get_json_info_ffprobe(filename):
-    '''Returns json info on filename for first video stream'''
-    args = [
-        "ffprobe", "-show_streams", "-print_format", "json",
+def prefilter_files(files, skipped):
+    '''Yields only the files for which is_video_file is True
+
+    Skipped files are appended to the list skipped.'''
+    for file_ in files:
+        if is_video_file(file_):
+            yield file_
+        else:
+            logging.debug("Skipping %s, not a video file", file_)
+            skipped.append(file_)
+
+
+def iter_file_list(folder):
+    '''Yields the files below folder lazily, in the order of sorted(file paths)
+
+    Subfolders are sorted as name + "/" among the files, so the files are
+    yielded in the same order as sorting the complete list of paths, e.g.
+    "a-b/x" before "a/y" before "b.MP4". Like os.walk symlinks to folders
+    are skipped, unreadable folders as well.'''
+
+    keys = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    keys.append(entry.name)
+                elif not entry.is_symlink():
+                    keys.append(entry.name + "/")
+    except OSError:
+        return
+    for key in sorted(keys):
+        if key.endswith("/"):
+            yield from iter_file_list(os.path.join(folder, key[:-1]))
+        else:
+            yield os.path.join(folder, key)
+
+
+def get_ffprobe_args(filename, fast=False):
+    '''Returns the ffprobe command line for filename
+
+    With fast only duration and creation_time of the first video stream are
+    requested and ffprobe reads only the first 1 MB of the file.'''
+    if fast:
+        return [
+            "ffprobe", "-probesize", "1000000", "-analyzeduration", "0",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=duration:stream_tags=creation_time",
+            "-print_format", "json",
+            filename
+            ]
+    return [
+        "ffprobe", "-show_streams", "-show_format", "-print_format", "json",
         filename
         ]
+
+
+def log_ffprobe_failure(filename, returncode, stderr_data):
+    '''Logs a failed ffprobe call, returns the error text for the error column'''
+    logging.warning("ffprobe returned non zero exit code %d for %s:", returncode, filename)
+    for line in stderr_data.decode(errors="replace").splitlines():
+        logging.warning("  %s", line)
+    return "ffprobe exit code %d" % returncode
+
+
+def get_json_info_ffprobe(filename, fast=False, timeout=FFPROBE_TIMEOUT):
+    '''Returns json info on filename for first video stream, see get_ffprobe_args'''
+    args = get_ffprobe_args(filename, fast)
     logging.info("Running ffprobe on %s", filename)
     proc = subprocess.Popen(args=args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
-    (stdout_data, stderr_data) = proc.communicate(timeout=15)
+    try:
+        (stdout_data, stderr_data) = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        logging.warning("ffprobe timed out for %s", filename)
+        return None
 
     if proc.returncode != 0:
-        logging.warning("ffmpeg returned non zero exit code for %s:", filename)
-        for line in stderr_data:
-            logging.warning("  %s", line)
-        for line in stdout_data:
-            logging.warning("  %s", line)
+        log_ffprobe_failure(filename, proc.returncode, stderr_data)
         return None
 
     return stdout_data
 
 
-def get_clips_info(folder, filelist):
+async def run_ffprobe(filename, fast=False, timeout=FFPROBE_TIMEOUT):
+    '''Runs ffprobe on filename asynchronously, see get_ffprobe_args
+
+    If ffprobe does not finish within timeout seconds or the call is
+    cancelled, the process is killed and reaped.
+
+    Returns (json info, None) on success and (None, error text) otherwise.'''
+    logging.info("Running ffprobe on %s", filename)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *get_ffprobe_args(filename, fast),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as error:
+        logging.warning("Cannot start ffprobe for %s: %s", filename, error)
+        return None, "cannot start ffprobe"
+
+    try:
+        (stdout_data, stderr_data) = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("ffprobe timed out after %d s for %s", timeout, filename)
+        return None, "timeout"
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    if proc.returncode != 0:
+        return None, log_ffprobe_failure(filename, proc.returncode, stderr_data)
+
+    return stdout_data, None
+
+
+# File extensions of ISO base media files which contain a moov/mvhd atom
+MVHD_EXTENSIONS = [".mp4", ".mov", ".m4v", ".3gp"]
+
+# Start of the time base of mvhd timestamps
+MVHD_EPOCH = datetime.datetime(1904, 1, 1)
+
+
+def find_mp4_box(data, box_type, start, end):
+    '''Returns (payload start, payload end) of the first box_type box in data[start:end]
+
+    Returns None if there is no such box.'''
+    offset = start
+    while offset + 8 <= end:
+        size, current_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            if offset + 16 > end:
+                return None
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return None
+        if current_type == box_type:
+            return offset + header_size, min(offset + size, end)
+        offset += size
+    return None
+
+
+def parse_mvhd(data):
+    '''Returns (duration in seconds, creation time) from the moov/mvhd box of MP4/MOV data
+
+    data can be anything supporting the buffer protocol, e.g. a mmap. Only the
+    box headers on the way to mvhd are read. creation time is a naive UTC
+    datetime or None if not set. Returns None if there is no valid mvhd box.'''
+    moov = find_mp4_box(data, b"moov", 0, len(data))
+    if moov is None:
+        return None
+    mvhd = find_mp4_box(data, b"mvhd", moov[0], moov[1])
+    if mvhd is None:
+        return None
+    start, end = mvhd
+    if end - start < 20:
+        return None
+    version = data[start]
+    if version == 1:
+        if end - start < 32:
+            return None
+        creation, _, timescale, duration = struct.unpack_from(">QQIQ", data, start + 4)
+    else:
+        creation, _, timescale, duration = struct.unpack_from(">IIII", data, start + 4)
+    if timescale == 0:
+        return None
+    timestamp = None
+    if creation:
+        timestamp = MVHD_EPOCH + datetime.timedelta(seconds=creation)
+    return duration / timescale, timestamp
+
+
+def get_json_info_mvhd(filename):
+    '''Returns json info like get_json_info_ffprobe from the mvhd box of MP4/MOV files
+
+    The file is memory mapped, so only the pages containing the box headers
+    are read. No process is started. Returns None if the file cannot be
+    parsed.'''
+    try:
+        with open(filename, "rb") as file_:
+            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                result = parse_mvhd(data)
+    except (OSError, ValueError, struct.error) as error:
+        logging.debug("Cannot parse %s: %s", filename, error)
+        return None
+    if result is None:
+        logging.debug("No mvhd box found in %s", filename)
+        return None
+    duration, timestamp = result
+    stream = {"duration": "%f" % duration}
+    if timestamp is not None:
+        stream["tags"] = {"creation_time": timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+    return json.dumps({"streams": [stream]}).encode()
+
+
+class ProbeCache:
+    '''Persistent cache of ffprobe results, stored in SQLite
+
+    Entries are keyed by absolute path, size and mtime_ns, so a changed file
+    is probed again. Only successful probes are stored. The cache can be used
+    from several threads.
+
+    The results of full and fast probes are stored in separate tables, as
+    fast probes contain less information.
+    '''
+
+    def __init__(self, filename, fast=False):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.table = "probes_fast" if fast else "probes"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, size INTEGER, "
+            "mtime_ns INTEGER, json TEXT)" % self.table)
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    def get(self, path, stat):
+        '''Returns the cached ffprobe output for path or None'''
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT json FROM %s WHERE path = ? AND size = ? AND mtime_ns = ?" % self.table,
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0].encode()
+
+    def put(self, path, stat, json_info):
+        '''Stores the ffprobe output for path
+
+        Changes are committed every 100 entries, so an aborted run keeps most
+        of its results.'''
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)" % self.table,
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, json_info.decode()))
+            self.uncommitted += 1
+            if self.uncommitted >= 100:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        '''Commits all changes and closes the cache file'''
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def get_json_info_without_ffprobe(filename, stat, cache=None, fast=False):
+    '''Returns json info like get_json_info_ffprobe if it is available without ffprobe
+
+    With fast MP4/MOV files are parsed with get_json_info_mvhd, otherwise the
+    cache is looked up if given. Returns None if ffprobe needs to be run.'''
+    if fast and os.path.splitext(filename)[1].lower() in MVHD_EXTENSIONS:
+        json_info = get_json_info_mvhd(filename)
+        if json_info is not None:
+            return json_info
+    if cache is not None:
+        json_info = cache.get(filename, stat)
+        if json_info is not None:
+            logging.debug("Using cached ffprobe result for %s", filename)
+            return json_info
+    return None
+
+
+def parse_rate(rate):
+    '''Returns a ffprobe frame rate like "30000/1001" as float, None if unknown'''
+    try:
+        numerator, _, denominator = rate.partition("/")
+        value = float(numerator) / float(denominator or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+    return round(value, 3) if value else None
+
+
+def get_columns_from_probe(json_decoded):
+    '''Returns all columns which can be taken from decoded ffprobe output
+
+    The first video stream is used, if there is no stream marked as video
+    (e.g. for fast probes) the first stream.'''
+
+    streams = json_decoded.get("streams", [])
+    if not streams:
+        return {}
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"),
+                 streams[0])
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), {})
+    format_ = json_decoded.get("format", {})
+
+    info = {}
+    info["duration_s"] = video.get("duration", format_.get("duration"))
+    try:
+        creation_time = video['tags']['creation_time']
+    except KeyError:
+        logging.warning("Cannot parse creation_time")
+    else:
+        # creation_time is something like "2019-04-16T19:33:33.000000Z",
+        # some muxers leave out the fractional seconds
+        for timestamp_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+            try:
+                info["timestamp"] = datetime.datetime.strptime(creation_time, timestamp_format)
+                break
+            except ValueError:
+                continue
+        else:
+            logging.warning("Cannot parse creation_time %r", creation_time)
+    optional = {
+        "codec": video.get("codec_name"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "fps": parse_rate(video.get("avg_frame_rate")) or parse_rate(video.get("r_frame_rate")),
+        "bitrate": video.get("bit_rate", format_.get("bit_rate")),
+        "pix_fmt": video.get("pix_fmt"),
+        "container": format_.get("format_name"),
+        "audio_codec": audio.get("codec_name"),
+        "audio_channels": audio.get("channels"),
+        "audio_sample_rate": audio.get("sample_rate"),
+        "audio_streams": sum(1 for stream in streams if stream.get("codec_type") == "audio")
+                         if "codec_type" in video else None,
+    }
+    info.update((key, value) for key, value in optional.items() if value is not None)
+    return info
+
+
+async def get_clip_info(folder, file_, cache=None, fast=False, timeout=FFPROBE_TIMEOUT):
+    '''Returns information on a single file, see get_clips_info
+
+    All COLUMNS which are known for the file are filled in. If the file
+    cannot be probed the reason is stored in the "error" column.'''
+
+    info = {}
+    info["filename"] = os.path.relpath(file_, folder)
+    try:
+        stat = os.stat(file_)
+    except OSError as error:
+        info["error"] = error.strerror
+        return info
+    info["size_mb"] = stat.st_size / 1000000
+
+    error = None
+    json_info = get_json_info_without_ffprobe(file_, stat, cache, fast)
+    if json_info is None:
+        json_info, error = await run_ffprobe(file_, fast, timeout)
+        if cache is not None and json_info is not None:
+            cache.put(file_, stat, json_info)
+    if json_info is not None:
+        try:
+            info.update(get_columns_from_probe(json.loads(json_info.decode())))
+        except ValueError:
+            logging.warning("Cannot decode ffprobe output for %s", file_)
+            error = "invalid ffprobe output"
+    if error is not None:
+        info["error"] = error
+    return info
+
+
+async def aiter_clips_info(folder, filelist, jobs=1, cache=None, fast=False,
+                           timeout=FFPROBE_TIMEOUT):
+    '''Yields information on the files in filelist, see get_clips_info
+
+    filelist can be any iterable, it is consumed lazily. At most jobs ffprobe
+    processes run at the same time, up to 4 * jobs files are scheduled ahead.
+    The results are yielded in the order of filelist as soon as they are
+    available. If the generator is closed early, pending probes are cancelled
+    and their ffprobe processes killed.
+    '''
+
+    semaphore = asyncio.Semaphore(max(jobs, 1))
+
+    async def probe(file_):
+        '''probes a single file, limited by semaphore'''
+        async with semaphore:
+            return await get_clip_info(folder, file_, cache, fast, timeout)
+
+    async def next_info():
+        '''returns the result of the oldest probe
+
+        asyncio.wait does not cancel the probe if this is cancelled, so all
+        pending probes are cancelled at once below and no new one starts.'''
+        await asyncio.wait([pending[0]])
+        return pending.popleft().result()
+
+    pending = collections.deque()
+    try:
+        for file_ in filelist:
+            pending.append(asyncio.ensure_future(probe(file_)))
+            if len(pending) >= 4 * max(jobs, 1):
+                yield await next_info()
+        while pending:
+            yield await next_info()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def iter_clips_info(folder, filelist, jobs=1, cache=None, fast=False, timeout=FFPROBE_TIMEOUT):
+    '''Synchronous wrapper around aiter_clips_info, yields information on the files
+
+    Each step runs as a task, so that it can be cancelled if the loop is
+    interrupted, e.g. by Ctrl-C. The running ffprobe processes are killed and
+    reaped before the exception is passed on.'''
+
+    loop = asyncio.new_event_loop()
+    agen = aiter_clips_info(folder, filelist, jobs, cache, fast, timeout)
+    step = None
+    try:
+        while True:
+            step = loop.create_task(agen.__anext__())
+            try:
+                yield loop.run_until_complete(step)
+            except StopAsyncIteration:
+                break
+    finally:
+        if step is not None and not step.done():
+            step.cancel()
+            loop.run_until_complete(asyncio.gather(step, return_exceptions=True))
+        loop.run_until_complete(agen.aclose())
+        remaining = asyncio.all_tasks(loop)
+        if remaining:
+            loop.run_until_complete(asyncio.gather(*remaining, return_exceptions=True))
+        loop.close()
+
+
+def get_clips_info(folder, filelist, jobs=1, cache=None, fast=False, timeout=FFPROBE_TIMEOUT):
     '''Returns information on a list of files
 
     Parameters:
 
-    filelist: List of files as ommited by get_file_list
+    filelist: Iterable of files, e.g. from iter_file_list
     folder: Base folder of files
+    jobs: Number of files probed in parallel. The result keeps the order of
+          filelist.
+    cache: ProbeCache, ffprobe is only run for files not found in it
+    fast: Only read duration and timestamp as fast as possible, see
+          get_json_info_without_ffprobe
+    timeout: Time in seconds after which ffprobe is killed
 
     Returns:
 
@@ -109,37 +641,358 @@ def get_clips_info(folder, filelist):
     ]
     '''
 
-    result = []
+    return list(iter_clips_info(folder, filelist, jobs, cache, fast, timeout))
+
+
+class Inotify:
+    '''Minimal inotify binding based on ctypes, Linux only'''
 
-    for file_ in filelist:
-        info = {}
-        info["filename"] = os.path.relpath(file_, folder)
-        info["size_mb"] = os.path.getsize(file_) / 1000000
-        json_info = get_json_info_ffprobe(file_)
-        if json_info != None:
-            json_decoded = json.loads(json_info.decode())
-            info["duration_s"] = json_decoded["streams"][0]["duration"]
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    # struct inotify_event without name: int wd, uint32 mask, cookie, len
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {} # watch descriptor -> folder
+
+    def add_watch(self, path, mask):
+        '''Watches path for events in mask'''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+        self.paths[wd] = path
+
+    def read_events(self, timeout=None):
+        '''Waits up to timeout seconds (None: forever) for events
+
+        Returns a list of (mask, full path) tuples, empty on timeout. If the
+        event queue overflowed, (IN_Q_OVERFLOW, None) is returned among them.'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        result = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                result.append((mask, None))
+                continue
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            folder = self.paths.get(wd)
+            if folder is not None:
+                result.append((mask, os.path.join(folder, name) if name else folder))
+        return result
+
+    def close(self):
+        '''Closes the inotify file descriptor'''
+        os.close(self.fd)
+
+
+def watch_folder(folder, debounce=5):
+    '''Watches folder recursively and yields files once they are completely written
+
+    A file is considered complete when it was closed after writing (or moved
+    into folder) and then neither modified nor changed in size for debounce
+    seconds. Files in newly created subfolders are picked up as well. Runs
+    until interrupted.
+
+    Files which already exist when watching starts are yielded as well
+    (after debounce), so files added while the caller was busy are not
+    missed. The caller has to skip the files it already knows. For the same
+    reason the whole folder is scanned again if inotify events were lost.
+    '''
+
+    inotify = Inotify()
+    mask = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE |
+            Inotify.IN_MODIFY)
+    pending = {} # file -> (deadline, size)
+
+    def schedule(path):
+        '''(re)starts the debounce time of path'''
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            pending.pop(path, None)
+            return
+        pending[path] = (time.monotonic() + debounce, size)
+
+    def add_tree(path):
+        '''watches path and its subfolders and schedules their existing files
+
+        Every folder is listed after its watch is added, so no file can be
+        created unnoticed in between.'''
+        for dirpath, _, _ in os.walk(path):
+            inotify.add_watch(dirpath, mask)
             try:
-                # creation_time is something like "2019-04-16T19:33:33.000000Z"
-                timestamp_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-                info["timestamp"] = datetime.datetime.strptime(
-                    json_decoded["streams"][0]['tags']['creation_time'],
-                    timestamp_format)
-            except KeyError:
-                logging.warning("Cannot parse creation_time")
-        result.append(info)
-    return result
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            schedule(entry.path)
+            except OSError:
+                continue
 
+    try:
+        add_tree(folder)
+        logging.info("Watching %s for new files", folder)
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(deadline for deadline, _ in pending.values()) -
+                              time.monotonic())
+            for event_mask, path in inotify.read_events(timeout):
+                if event_mask & Inotify.IN_Q_OVERFLOW:
+                    logging.warning("inotify event queue overflow, rescanning %s", folder)
+                    add_tree(folder)
+                elif event_mask & Inotify.IN_ISDIR:
+                    if event_mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        # Files may have been written before the watch was added
+                        add_tree(path)
+                elif event_mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    schedule(path)
+                elif event_mask & Inotify.IN_MODIFY and path in pending:
+                    schedule(path)
+            now = time.monotonic()
+            for path, (deadline, size) in list(pending.items()):
+                if deadline > now:
+                    continue
+                try:
+                    current_size = os.stat(path).st_size
+                except OSError:
+                    del pending[path]
+                    continue
+                if current_size != size:
+                    schedule(path)
+                    continue
+                del pending[path]
+                yield path
+    finally:
+        inotify.close()
 
-def convert_clips_info_to_csv(clips_infos, csvfile):
-    '''Convert clips_infos as returned by get_clips_info to csvfile'''
 
-    with open(csvfile, 'w', newline='') as file_:
-        fieldnames = ["filename", "size_mb", "duration_s", "timestamp"]
-        writer = csv.DictWriter(file_, fieldnames=fieldnames, restval="N/A", delimiter=";")
-        writer.writeheader()
+CSV_DELIMITER = ";"
+
+
+def read_done_filenames(outfile, output_format="csv"):
+    '''Returns the set of file names listed in an existing CSV or JSON Lines file
+
+    An incomplete last line, e.g. from an aborted run, is removed from the
+    file, so that new rows can be appended. Returns None if the file does not
+    exist or a CSV file has no header.
+    '''
+
+    if not os.path.exists(outfile):
+        return None
+    with open(outfile, "r+b") as file_:
+        content = file_.read()
+        if content and not content.endswith(b"\n"):
+            file_.truncate(content.rfind(b"\n") + 1)
+    with open(outfile, "r", newline="") as file_:
+        if output_format == "jsonl":
+            return {json.loads(line)["filename"] for line in file_ if line.strip()}
+        reader = csv.DictReader(file_, delimiter=CSV_DELIMITER)
+        if reader.fieldnames is None:
+            return None
+        return {row["filename"] for row in reader}
+
+
+def read_csv_columns(outfile):
+    '''Returns the column names of the header of an existing CSV file or None'''
+    try:
+        with open(outfile, "r", newline="") as file_:
+            return csv.DictReader(file_, delimiter=CSV_DELIMITER).fieldnames
+    except FileNotFoundError:
+        return None
+
+
+def write_clips_info(clips_infos, outfile, columns=None, output_format="csv", append=False):
+    '''Writes clips_infos to outfile, row by row
+
+    Only the given columns (default DEFAULT_COLUMNS) are written, unknown
+    values are "N/A" in CSV and null in JSON Lines. Every row is flushed as
+    soon as it is written, so the file is usable even if the run is aborted.
+    With append the CSV header is not written and the rows are appended to
+    outfile.
+    '''
+
+    columns = columns or DEFAULT_COLUMNS
+    with open(outfile, "a" if append else "w", newline="") as file_:
+        if output_format == "jsonl":
+            for clip_info in clips_infos:
+                row = {column: clip_info.get(column) for column in columns}
+                file_.write(json.dumps(row, default=str) + "\n")
+                file_.flush()
+            return
+        writer = csv.DictWriter(file_, fieldnames=columns, restval="N/A",
+                                extrasaction="ignore", delimiter=CSV_DELIMITER)
+        if not append:
+            writer.writeheader()
         for clip_info in clips_infos:
             writer.writerow(clip_info)
+            file_.flush()
+
+
+class Summary:
+    '''Totals of clips grouped by date or subfolder, computed in a single pass'''
+
+    FIELDNAMES = ["group", "clips", "duration_s", "size_mb", "first_timestamp",
+                  "last_timestamp"]
+
+    def __init__(self, group_by="date"):
+        self.group_by = group_by
+        self.groups = {}
+
+    def get_group(self, clip_info):
+        '''Returns the group name of clip_info'''
+        if self.group_by == "folder":
+            return os.path.dirname(clip_info["filename"]) or "."
+        timestamp = clip_info.get("timestamp")
+        return timestamp.date().isoformat() if timestamp is not None else "unknown"
+
+    def add(self, clip_info):
+        '''Adds a single clip as returned by get_clip_info'''
+        group = self.groups.setdefault(self.get_group(clip_info), {
+            "clips": 0, "duration_s": 0.0, "size_mb": 0.0,
+            "first_timestamp": None, "last_timestamp": None})
+        group["clips"] += 1
+        group["size_mb"] += clip_info.get("size_mb", 0.0)
+        try:
+            group["duration_s"] += float(clip_info.get("duration_s"))
+        except (TypeError, ValueError):
+            pass
+        timestamp = clip_info.get("timestamp")
+        if timestamp is not None:
+            if group["first_timestamp"] is None or timestamp < group["first_timestamp"]:
+                group["first_timestamp"] = timestamp
+            if group["last_timestamp"] is None or timestamp > group["last_timestamp"]:
+                group["last_timestamp"] = timestamp
+
+    def rows(self):
+        '''Returns a list of dicts with FIELDNAMES, sorted by group'''
+        result = []
+        for name, values in sorted(self.groups.items()):
+            row = dict(group=name, **values)
+            row["duration_s"] = round(row["duration_s"], 3)
+            row["size_mb"] = round(row["size_mb"], 6)
+            result.append(row)
+        return result
+
+    def write(self, filename):
+        '''Writes the summary as JSON if filename ends with .json, as CSV otherwise'''
+        with open(filename, "w", newline="") as file_:
+            if filename.lower().endswith(".json"):
+                json.dump(self.rows(), file_, default=str, indent=2)
+                file_.write("\n")
+                return
+            writer = csv.DictWriter(file_, fieldnames=self.FIELDNAMES, restval="N/A",
+                                    delimiter=CSV_DELIMITER)
+            writer.writeheader()
+            for row in self.rows():
+                writer.writerow({key: value for key, value in row.items() if value is not None})
+
+
+def summarize(clips_infos, summary):
+    '''Adds every clip to summary while passing clips_infos through (yield)'''
+    for clip_info in clips_infos:
+        summary.add(clip_info)
+        yield clip_info
+
+
+class DuplicateFinder:
+    '''Finds identical clips without reading every file completely
+
+    Clips are bucketed by size and duration from the probe result. Only clips
+    in the same bucket are compared, first by a hash over the first and last
+    PARTIAL_HASH_SIZE bytes and, if that matches, by a hash over the whole
+    file. Hashes are computed lazily and only once per file.
+    '''
+
+    PARTIAL_HASH_SIZE = 1024 * 1024
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.buckets = {} # (size_mb, duration_s) -> [{"filename": ..., hashes}]
+
+    def get_partial_hash(self, entry):
+        '''Returns the hash of first and last PARTIAL_HASH_SIZE bytes of entry'''
+        if "partial_hash" not in entry:
+            hash_ = hashlib.sha256()
+            with open(os.path.join(self.folder, entry["filename"]), "rb") as file_:
+                hash_.update(file_.read(self.PARTIAL_HASH_SIZE))
+                size = os.fstat(file_.fileno()).st_size
+                if size > self.PARTIAL_HASH_SIZE:
+                    file_.seek(max(self.PARTIAL_HASH_SIZE, size - self.PARTIAL_HASH_SIZE))
+                    hash_.update(file_.read(self.PARTIAL_HASH_SIZE))
+            entry["partial_hash"] = hash_.digest()
+        return entry["partial_hash"]
+
+    def get_full_hash(self, entry):
+        '''Returns the hash of the whole content of entry'''
+        if "full_hash" not in entry:
+            hash_ = hashlib.sha256()
+            with open(os.path.join(self.folder, entry["filename"]), "rb") as file_:
+                for block in iter(lambda: file_.read(self.PARTIAL_HASH_SIZE), b""):
+                    hash_.update(block)
+            entry["full_hash"] = hash_.digest()
+        return entry["full_hash"]
+
+    def check(self, clip_info):
+        '''Returns the file name of an earlier identical clip or None
+
+        clip_info is remembered for the following calls. Clips without
+        duration (e.g. failed probes) are never considered duplicates.'''
+        if clip_info.get("duration_s") is None or "size_mb" not in clip_info:
+            return None
+        bucket = self.buckets.setdefault((clip_info["size_mb"], clip_info["duration_s"]), [])
+        entry = {"filename": clip_info["filename"]}
+        result = None
+        try:
+            for candidate in bucket:
+                if self.get_partial_hash(candidate) == self.get_partial_hash(entry) and \
+                        self.get_full_hash(candidate) == self.get_full_hash(entry):
+                    result = candidate["filename"]
+                    break
+        except OSError as error:
+            logging.warning("Cannot compare %s: %s", clip_info["filename"], error)
+            return None
+        if result is None:
+            bucket.append(entry)
+        return result
+
+
+def mark_duplicates(clips_infos, finder):
+    '''Sets duplicate_of for clips which are identical to an earlier clip (yield)'''
+    for clip_info in clips_infos:
+        duplicate_of = finder.check(clip_info)
+        if duplicate_of is not None:
+            logging.info("%s is a duplicate of %s", clip_info["filename"], duplicate_of)
+            clip_info["duplicate_of"] = duplicate_of
+        yield clip_info
+
+
+def convert_clips_info_to_csv(clips_infos, csvfile):
+    '''Convert clips_infos as returned by get_clips_info to csvfile'''
+
+    write_clips_info(clips_infos, csvfile)
 
 
 def main():
@@ -152,12 +1005,67 @@ def main():
         logging.error("Cannot find ffprobe. Install ffmpeg first")
         sys.exit(1)
 
-    file_list = get_file_list(args.folder)
-    file_list.sort()
+    file_list = iter_file_list(args.folder)
+    skipped = []
+    if not args.no_prefilter:
+        file_list = prefilter_files(file_list, skipped)
+
+    done = None
+    if args.resume or args.watch:
+        done = read_done_filenames(args.csvfile, args.format)
+    if done is not None:
+        logging.info("Resuming, %d files already in %s", len(done), args.csvfile)
+        columns = read_csv_columns(args.csvfile) if args.format == "csv" else None
+        if columns and columns != args.columns:
+            logging.info("Keeping the columns of %s: %s", args.csvfile, ",".join(columns))
+            args.columns = columns
+        file_list = (file_ for file_ in file_list
+                     if os.path.relpath(file_, args.folder) not in done)
+
+    cache = None if args.no_cache else ProbeCache(args.cache, args.fast)
+    try:
+        clips_info = iter_clips_info(args.folder, file_list, args.jobs, cache, args.fast,
+                                     args.timeout)
+        if args.find_duplicates:
+            clips_info = mark_duplicates(clips_info, DuplicateFinder(args.folder))
+        summary = None
+        if args.summary:
+            summary = Summary(args.summary_by)
+            clips_info = summarize(clips_info, summary)
+        write_clips_info(clips_info, args.csvfile, args.columns, args.format,
+                         append=done is not None)
+        if summary is not None:
+            summary.write(args.summary)
+        if args.watch:
+            watch(args, cache)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        logging.info("Stopped watching %s", args.folder)
+    finally:
+        if cache is not None:
+            cache.close()
+            logging.info("ffprobe cache: %d hits, %d misses", cache.hits, cache.misses)
+        if not args.no_prefilter:
+            logging.info("Prefilter skipped %d non video files (ffprobe calls avoided)",
+                         len(skipped))
+
 
-    clips_info = get_clips_info(args.folder, file_list)
+def watch(args, cache):
+    '''Probes files completed in args.folder and appends them to args.csvfile, see --watch'''
 
-    convert_clips_info_to_csv(clips_info, args.csvfile)
+    done = read_done_filenames(args.csvfile, args.format) or set()
+    for file_ in watch_folder(args.folder, args.debounce):
+        filename = os.path.relpath(file_, args.folder)
+        if filename in done:
+            logging.debug("%s is already listed. Skip", filename)
+            continue
+        if not args.no_prefilter and not is_video_file(file_):
+            logging.debug("Skipping %s, not a video file", file_)
+            continue
+        clips_info = iter_clips_info(args.folder, [file_], 1, cache, args.fast, args.timeout)
+        write_clips_info(clips_info, args.csvfile, args.columns, args.format, append=True)
+        done.add(filename)
 
 
 if __name__ == "__main__":
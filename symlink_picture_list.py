@@ -28,9 +28,80 @@
 
 # Standard library imports:
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import errno
+import fcntl
 import logging
+import mmap
 import os
+import re
+import sqlite3
 import sys
+import threading
+import time
+
+
+GLOB_CHARS = "*?["
+REGEX_PREFIX = "re:"
+REGEX_CHARS = ".^$*+?{}[]\\|()"
+INCLUDE_PREFIX = "include "
+MODES = ["symlink", "hardlink", "reflink", "copy"]
+COPY_MODES = ["reflink", "copy"]
+FICLONE = 0x40049409 # from linux/fs.h
+REFLINK_ERRNOS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS)
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+SYSCALLS = ["scandir", "readlink", "stat", "lstat", "mkdir", "symlink", "link", "copy",
+            "rename", "unlink"]
+ENTRY_COUNTERS = ["created", "unchanged", "conflicts", "renamed", "removed", "replaced",
+                  "failed"]
+
+
+class Stats:
+    '''Wall time per phase and counters of syscalls and entries, see --stats
+
+    Counting is thread safe. Phases with the same name are added up.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.counters = collections.Counter()
+
+    def count(self, name, number=1):
+        '''Adds number to the counter name'''
+        with self.lock:
+            self.counters[name] += number
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Context manager adding the wall time of its body to phase name'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def log(self):
+        '''Logs the summary'''
+        for name, seconds in self.times.items():
+            logging.info("%-8s %8.3f s", name, seconds)
+        logging.info("%-8s %8.3f s", "total", sum(self.times.values()))
+        logging.info("syscalls: %s", ", ".join(
+            "%s %d" % (name, self.counters[name]) for name in SYSCALLS))
+        logging.info("entries: %s", ", ".join(
+            "%s %d" % (name, self.counters[name]) for name in ENTRY_COUNTERS))
+
+
+STATS = Stats()
+
+
+def get_default_cache_file():
+    '''Returns the default cache file name below XDG_CACHE_HOME'''
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "symlink_picture_list", "filelist_cache.sqlite")
 
 
 def get_args():
@@ -41,6 +112,38 @@ def get_args():
         "-v", "--verbose", dest="debuglevel", action="store_const",
         const=logging.DEBUG, default=logging.INFO,
         help="Enables verbose/debug output.")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Only print the planned changes, do not touch outdir.")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Replace existing entries which do not point to the planned source.")
+    parser.add_argument(
+        "--sync", action="store_true",
+        help="Make outdir match indir: rename or remove symlinks which are not planned "
+        "anymore and replace symlinks which point to another source.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=16,
+        help="Number of threads checking or copying the sources in parallel. "
+        "Defaults to %(default)s.")
+    parser.add_argument(
+        "-m", "--mode", choices=MODES, default="symlink",
+        help="Create symlinks, hardlinks, reflinks (btrfs, xfs) or copies of the "
+        "sources. Defaults to %(default)s.")
+    parser.add_argument(
+        "--cache", default=get_default_cache_file(),
+        help="SQLite file caching parsed and checked filelists by path, size and mtime. "
+        "Defaults to %(default)s.")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Neither read nor write the filelist cache.")
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="Print the wall time per phase, the number of syscalls and of created, "
+        "unchanged and conflicting entries.")
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="Run with cProfile and write the profile to FILE, e.g. for pstats or snakeviz.")
     parser.add_argument(
         "indir",
         help="directory structure with filelist.txt files, one path name per line")
@@ -53,48 +156,616 @@ def get_args():
 def read_list(filepath):
     '''Reads the list from filepath and returns an array with filenames'''
     result = []
-    file_ = open(filepath, "r")
-    for line in file_:
-        if len(line) <= 1 or line.startswith("#"): # Skip empty and comment lines
-            pass
+    with open(filepath, "rb") as file_:
+        if os.fstat(file_.fileno()).st_size == 0:
+            return result
+        with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line in iter(data.readline, b""):
+                line = line.strip()
+                if line and not line.startswith(b"#"): # Skip empty and comment lines
+                    result.append(os.fsdecode(line))
+    return result
+
+
+def is_literal(entry):
+    '''Returns True if the filelist entry is a path and no pattern or include
+
+    Entries with glob characters are paths if they exist, e.g. "IMG [1].jpg".'''
+    if entry.startswith(REGEX_PREFIX) or entry.startswith(INCLUDE_PREFIX):
+        return False
+    return not any(char in entry for char in GLOB_CHARS) or os.path.lexists(entry)
+
+
+def get_include_path(filelist, entry):
+    '''Returns the path of the include entry, relative paths are relative to filelist'''
+    return os.path.normpath(os.path.join(os.path.dirname(filelist),
+                                         entry[len(INCLUDE_PREFIX):].strip()))
+
+
+def get_pattern_root(pattern, special_chars):
+    '''Returns the folder before the first of special_chars in pattern'''
+    for index, char in enumerate(pattern):
+        if char in special_chars:
+            pattern = pattern[:index]
+            break
+    return os.path.dirname(pattern) or os.curdir
+
+
+def translate_glob(pattern):
+    '''Returns a regular expression for the glob pattern
+
+    * and ? do not match /, **/ matches any number of folders.'''
+    result = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            result.append("(?:.*/)?")
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            result.append(".*")
+            index += 2
+            continue
+        end = pattern.find("]", index + 2) if char == "[" else -1
+        if char == "*":
+            result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif end != -1:
+            content = pattern[index + 1:end].replace("\\", "\\\\")
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            result.append("[%s]" % content)
+            index = end
+        else:
+            result.append(re.escape(char))
+        index += 1
+    return "".join(result)
+
+
+class SourceWalker:
+    '''Expands glob and regex entries with a memoised walk of the source folders
+
+    Every folder is walked at most once, the files of its subfolders are
+    taken from the sorted result. The matches of a pattern are remembered as
+    well, so many filelists can use the same patterns cheaply.
+    '''
+
+    def __init__(self):
+        self.files = {} # root -> sorted list of all file paths below root
+        self.matches = {} # entry -> list of matching file paths
+        self.walks = 0
+
+    def get_files(self, root):
+        '''Returns a sorted list of all files below root'''
+        if root not in self.files:
+            for walked, files in self.files.items():
+                prefix = os.path.join(walked, "")
+                if root.startswith(prefix):
+                    prefix = os.path.join(root, "")
+                    self.files[root] = files[bisect.bisect_left(files, prefix):
+                                             bisect.bisect_left(files, prefix[:-1] + "0")]
+                    break
+            else:
+                self.walks += 1
+                result = []
+                for dirpath, _dirnames, filenames in os.walk(root):
+                    STATS.count("scandir")
+                    result.extend(os.path.join(dirpath, filename) for filename in filenames)
+                if root == os.curdir: # match like normalised patterns, "a.jpg" not "./a.jpg"
+                    result = [path[len(os.curdir) + 1:] for path in result]
+                result.sort()
+                self.files[root] = result
+        return self.files[root]
+
+    def expand(self, entry):
+        '''Returns the sorted list of files matching the glob or regex entry
+
+        Patterns are matched against normalised paths, so a leading "./" is
+        ignored and relative patterns match relative paths.'''
+        if entry not in self.matches:
+            if entry.startswith(REGEX_PREFIX):
+                pattern = entry[len(REGEX_PREFIX):]
+                while pattern.startswith("./"):
+                    pattern = pattern[2:]
+                root = get_pattern_root(pattern, REGEX_CHARS)
+            else:
+                glob = os.path.normpath(entry)
+                pattern = translate_glob(glob)
+                root = get_pattern_root(glob, GLOB_CHARS)
+            try:
+                regex = re.compile(pattern)
+            except re.error as error:
+                logging.error("Invalid pattern %s: %s", entry, error)
+                regex = None
+            self.matches[entry] = [] if regex is None else \
+                [path for path in self.get_files(os.path.normpath(root)) if regex.fullmatch(path)]
+            if not self.matches[entry]:
+                logging.warning("No files match %s", entry)
+        return self.matches[entry]
+
+
+def expand_list(path, lists, walker, stack=()):
+    '''Returns the entries of filelist path with includes and patterns expanded
+
+    lists is a dict path -> entries of all filelists including the included
+    ones, see load_filelists().'''
+    if path in stack:
+        logging.error("Recursive include of %s in %s", path, stack[-1])
+        return []
+    result = []
+    for entry in lists.get(path, []):
+        if entry.startswith(INCLUDE_PREFIX):
+            result.extend(expand_list(get_include_path(path, entry), lists, walker,
+                                      stack + (path,)))
+        elif is_literal(entry):
+            result.append(entry)
         else:
-            result.append(line.strip())
+            result.extend(walker.expand(entry))
     return result
 
 
-def check_and_create_symlink(source, symlink_file):
-    '''Checks and creates a symlink if possible
+def find_missing_sources(sources, jobs=16):
+    '''Returns the set of sources which do not exist
+
+    The sources are checked in jobs threads, as they are often on a network
+    file system.'''
+    sources = sorted(set(sources))
+    STATS.count("stat", len(sources))
+    chunks = [sources[start:start + 1000] for start in range(0, len(sources), 1000)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return set().union(*executor.map(
+            lambda chunk: {source for source in chunk if not os.path.exists(source)}, chunks))
+
+
+class ListCache:
+    '''Persistent cache of parsed and checked filelists, stored in SQLite
+
+    Entries are keyed by absolute path, size and mtime_ns, so a changed
+    filelist is parsed and checked again. Sources which disappear while
+    their filelist is unchanged are not noticed.
+    '''
 
-    Arguments:
-       source: where the symlink points to
-       symlink_file: the filesystem entry representing the symlink
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS lists (path TEXT PRIMARY KEY, size INTEGER, "
+            "mtime_ns INTEGER, entries TEXT, missing TEXT)")
+        self.hits = 0
+        self.misses = 0
 
-    Calls sys.exit(1) in case that a symlink exists, but points to another source.
-       '''
-    if os.path.lexists(symlink_file):
-        if os.path.islink(symlink_file) and os.readlink(symlink_file) == source:
-            logging.debug("Symlink %s to %s already exists. Skip", symlink_file, source)
+    def get(self, path, stat):
+        '''Returns (entries, missing) cached for path or None'''
+        row = self.connection.execute(
+            "SELECT entries, missing FROM lists WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [entry for entry in row[0].split("\n") if entry], \
+            {entry for entry in row[1].split("\n") if entry}
+
+    def put(self, path, stat, entries, missing):
+        '''Stores the entries and missing sources of path'''
+        self.connection.execute(
+            "INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?, ?)",
+            (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, "\n".join(entries),
+             "\n".join(sorted(missing))))
+
+    def close(self):
+        '''Commits all changes and closes the cache file'''
+        self.connection.commit()
+        self.connection.close()
+
+
+def load_filelists(paths, cache=None, jobs=16):
+    '''Reads and checks the filelists in paths, returns a dict path -> entries
+
+    Included filelists are loaded as well. Only filelists which are not in
+    cache are parsed, the literal sources of all of them are checked
+    together. Missing sources are logged. Glob, regex and include entries
+    are expanded with one SourceWalker for all filelists.'''
+    lists = {}
+    missing = {}
+    uncached = []
+    pending = list(paths)
+    with STATS.phase("parse"):
+        while pending:
+            path = pending.pop()
+            if path in lists:
+                continue
+            try:
+                STATS.count("stat")
+                stat = os.stat(path)
+            except OSError as error:
+                logging.error("Cannot read filelist: %s", error)
+                lists[path] = []
+                missing[path] = set()
+                continue
+            cached = None if cache is None else cache.get(path, stat)
+            if cached is None:
+                uncached.append((path, stat))
+                lists[path] = read_list(path)
+            else:
+                lists[path], missing[path] = cached
+            pending.extend(get_include_path(path, entry) for entry in lists[path]
+                           if entry.startswith(INCLUDE_PREFIX))
+    with STATS.phase("check"):
+        all_missing = find_missing_sources(
+            [entry for path, _stat in uncached for entry in lists[path] if is_literal(entry)],
+            jobs)
+        for path, stat in uncached:
+            missing[path] = all_missing.intersection(lists[path])
+            if cache is not None:
+                cache.put(path, stat, lists[path], missing[path])
+        for path in sorted(lists):
+            for entry in sorted(missing[path]):
+                logging.warning("Missing source %s in %s", entry, path)
+    with STATS.phase("expand"):
+        walker = SourceWalker()
+        result = {path: expand_list(path, lists, walker) for path in paths}
+    logging.debug("%d source folders walked for %d patterns", walker.walks, len(walker.matches))
+    return result
+
+
+def get_existing_entries(dir_fd, files=None):
+    '''Lists the directory dir_fd once and returns a dict name -> symlink target
+
+    Entries which are no symlinks are mapped to None. The names of regular
+    files are added to the set files if given.'''
+    existing = {}
+    STATS.count("scandir")
+    with os.scandir(dir_fd) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                STATS.count("readlink")
+                existing[entry.name] = os.readlink(entry.name, dir_fd=dir_fd)
+            else:
+                existing[entry.name] = None
+                if files is not None and entry.is_file(follow_symlinks=False):
+                    files.add(entry.name)
+    return existing
+
+
+def get_numbered_names(filelist):
+    '''Returns a list of (name, source) for the files in filelist
+
+    All filenames are pretended by 000_, 001_, 002_ etc.'''
+    return [("%03d_%s" % (counter, os.path.basename(entry)), entry)
+            for counter, entry in enumerate(filelist)]
+
+
+class FolderPlan:
+    '''Planned changes of one folder in outdir
+
+    Symlinks are planned by default. With another mode (see MODES) hardlinks
+    or copies are planned, existing entries are compared by inode or by size
+    and mtime with the source.
+
+    Attributes:
+       path: path of the folder
+       mode: one of MODES
+       exists: False if the folder has to be created
+       existing: dict of the entries in the folder, see get_existing_entries()
+       files: set of the names of the regular files in the folder
+       create: list of (name, source) for new symlinks
+       unchanged: list of (name, source) for symlinks which already point to source
+       conflicts: list of (name, source, current) for entries which are in the way,
+                  current is the current symlink target or None for other entries
+       rename: list of (old_name, name) for symlinks which can be reused, see sync()
+       remove: list of names of entries which are not planned anymore, see sync()
+       replace: list of (name, source) for entries to be replaced, see sync()
+    '''
+
+    def __init__(self, path, mode="symlink"):
+        self.path = path
+        self.mode = mode
+        self.files = set()
+        try:
+            dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            self.exists = False
+            self.existing = {}
+        else:
+            self.exists = True
+            try:
+                self.existing = get_existing_entries(dir_fd, self.files)
+            finally:
+                os.close(dir_fd)
+        self.planned = {}
+        self.create = []
+        self.unchanged = []
+        self.conflicts = []
+        self.rename = []
+        self.remove = []
+        self.replace = []
+
+    def add(self, name, source):
+        '''Plans a symlink name in this folder pointing to source'''
+        if name in self.planned:
+            if self.planned[name] != source:
+                self.conflicts.append((name, source, self.planned[name]))
+            return
+        self.planned[name] = source
+        if name not in self.existing:
+            self.create.append((name, source))
+        elif self.is_unchanged(name, source):
+            self.unchanged.append((name, source))
         else:
-            logging.error("%s exists, but does not point to %s", symlink_file, source)
-            sys.exit(1)
+            self.conflicts.append((name, source, self.existing[name]))
+
+    def is_unchanged(self, name, source):
+        '''Returns True if the existing entry name is already what mode creates for source'''
+        if self.mode == "symlink":
+            return self.existing[name] == source
+        if self.existing[name] is not None:
+            return False
+        try:
+            STATS.count("stat")
+            source_stat = os.stat(source)
+            STATS.count("lstat")
+            stat = os.stat(os.path.join(self.path, name), follow_symlinks=False)
+        except OSError:
+            return False
+        if self.mode == "hardlink":
+            return os.path.samestat(source_stat, stat)
+        return (stat.st_size, stat.st_mtime_ns) == (source_stat.st_size, source_stat.st_mtime_ns)
+
+    def sync(self):
+        '''Plans the minimal changes to make the entries match the planned ones
+
+        Symlinks which are not planned are renamed if a symlink to the same
+        source has to be created, otherwise they are removed. In the other
+        modes unplanned symlinks and regular files are removed, as hardlinks
+        and copies cannot be told apart from other files by their target.
+        Planned entries which are outdated are replaced. Folders and other
+        entries stay conflicts. Call after all add() calls.'''
+        replaceable = set(name for name, current in self.existing.items() if current is not None)
+        if self.mode != "symlink":
+            replaceable.update(self.files)
+        stale = {} # source (or None) -> names of entries which are not planned
+        for name in replaceable:
+            if name not in self.planned:
+                key = self.existing[name] if self.mode == "symlink" else None
+                stale.setdefault(key, []).append(name)
+        create = []
+        for name, source in self.create:
+            if self.mode == "symlink" and stale.get(source):
+                self.rename.append((stale[source].pop(), name))
+            else:
+                create.append((name, source))
+        self.create = create
+        self.remove = sorted(name for names in stale.values() for name in names)
+        conflicts = []
+        for name, source, current in self.conflicts:
+            if name in replaceable and self.planned[name] == source:
+                self.replace.append((name, source))
+            else:
+                conflicts.append((name, source, current))
+        self.conflicts = conflicts
+
+
+def log_plans(plans):
+    '''Logs plans as a diff and returns the number of conflicts'''
+    creates = unchanged = conflicts = changes = 0
+    for plan in plans:
+        if not plan.exists:
+            logging.info("+ %s/", plan.path)
+        for name, source in plan.unchanged:
+            logging.debug("  %s -> %s", os.path.join(plan.path, name), source)
+        for old_name, name in plan.rename:
+            logging.info("~ %s => %s", os.path.join(plan.path, old_name), name)
+        for name in plan.remove:
+            logging.info("- %s", os.path.join(plan.path, name))
+        for name, source in plan.create:
+            logging.info("+ %s -> %s", os.path.join(plan.path, name), source)
+        for name, source in plan.replace:
+            logging.info("~ %s -> %s", os.path.join(plan.path, name), source)
+        for name, source, current in plan.conflicts:
+            if current is None:
+                logging.warning("! %s exists, but is no %s of %s", os.path.join(plan.path, name),
+                                plan.mode, source)
+            else:
+                logging.warning("! %s -> %s, but should be a %s of %s",
+                                os.path.join(plan.path, name), current, plan.mode, source)
+        creates += len(plan.create)
+        unchanged += len(plan.unchanged)
+        conflicts += len(plan.conflicts)
+        changes += len(plan.rename) + len(plan.remove) + len(plan.replace)
+    STATS.count("unchanged", unchanged)
+    STATS.count("conflicts", conflicts)
+    logging.info("%d to create, %d to rename/remove/replace, %d unchanged, %d conflicts",
+                 creates, changes, unchanged, conflicts)
+    return conflicts
+
+
+def copy_data(in_fd, out_fd):
+    '''Copies the rest of in_fd to out_fd without passing the data through user space
+
+    Uses os.copy_file_range() and falls back to os.sendfile(), e.g. across
+    file systems on older kernels.'''
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(in_fd, out_fd, COPY_CHUNK_SIZE):
+                pass
+            return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while os.sendfile(out_fd, in_fd, None, COPY_CHUNK_SIZE):
+        pass
+
+
+def copy_file(source, name, reflink=False, dir_fd=None):
+    '''Copies source to the new file name (relative to dir_fd), keeping the mtime
+
+    With reflink the data blocks are shared with the FICLONE ioctl (btrfs,
+    xfs). If that is not supported the data is copied with copy_data().
+    Returns False if a reflink was requested but the data was copied.'''
+    reflinked = False
+    STATS.count("copy")
+    with open(source, "rb") as source_file:
+        stat = os.fstat(source_file.fileno())
+        dest_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.st_mode & 0o777,
+                          dir_fd=dir_fd)
+        try:
+            if reflink:
+                try:
+                    fcntl.ioctl(dest_fd, FICLONE, source_file.fileno())
+                    reflinked = True
+                except OSError as error:
+                    if error.errno not in REFLINK_ERRNOS:
+                        raise
+            if not reflinked:
+                copy_data(source_file.fileno(), dest_fd)
+            os.utime(dest_fd, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        except BaseException:
+            os.close(dest_fd)
+            os.unlink(name, dir_fd=dir_fd)
+            raise
+        os.close(dest_fd)
+    return reflinked or not reflink
+
+
+def create_entry(source, name, mode="symlink", dir_fd=None):
+    '''Creates name (relative to dir_fd) as symlink, hardlink, reflink or copy of source
+
+    Returns False if a reflink was not possible and the data was copied.'''
+    if mode == "symlink":
+        STATS.count("symlink")
+        os.symlink(source, name, dir_fd=dir_fd)
+    elif mode == "hardlink":
+        STATS.count("link")
+        os.link(source, name, dst_dir_fd=dir_fd)
     else:
-        logging.info("Symlink " + source + " to " + symlink_file)
-        os.symlink(source, symlink_file)
+        return copy_file(source, name, mode == "reflink", dir_fd)
+    return True
 
 
-def symlink_files(filelist, outdir):
-    '''Symlinks the files in list to outdir.
+def replace_entry(source, name, mode="symlink", dir_fd=None):
+    '''Atomically replaces the entry name (relative to dir_fd) like create_entry()
 
-    All filenames are pretended by 000_, 001_, 002_ etc.'''
+    The new entry is created with a temporary name and renamed to name.'''
+    temp_name = os.path.join(os.path.dirname(name),
+                             ".%s.%d.tmp" % (os.path.basename(name), os.getpid()))
+    result = create_entry(source, temp_name, mode, dir_fd)
+    STATS.count("rename")
+    try:
+        os.rename(temp_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except OSError:
+        os.unlink(temp_name, dir_fd=dir_fd)
+        raise
+    return result
+
+
+def copy_files(copies, mode, jobs=16):
+    '''Creates the list of (source, path, replace) as reflinks or copies in jobs threads
+
+    The progress is logged every second. Returns the number of failed copies.'''
+    failed = fallbacks = done = 0
+    last_log = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(replace_entry if replace else create_entry,
+                                   source, path, mode): (path, replace)
+                   for source, path, replace in copies}
+        for future in concurrent.futures.as_completed(futures):
+            done += 1
+            path, replace = futures[future]
+            try:
+                if not future.result():
+                    fallbacks += 1
+                STATS.count("replaced" if replace else "created")
+            except OSError as error:
+                logging.error("Cannot create %s: %s", path, error)
+                failed += 1
+            if time.monotonic() - last_log >= 1 or done == len(copies):
+                logging.info("%d/%d files done", done, len(copies))
+                last_log = time.monotonic()
+    if fallbacks:
+        logging.warning("%d files copied because reflinks are not supported", fallbacks)
+    return failed
+
+
+def apply_plans(plans, force=False, jobs=16):
+    '''Creates folders and entries of plans, replaces conflicts only with force
+
+    Symlinks and hardlinks are created directly, reflinks and copies in jobs
+    threads once all folders exist.
+    Returns the number of entries which could not be created or replaced.'''
+    failed = 0
+    copies = []
+    for plan in plans:
+        if not plan.exists:
+            STATS.count("mkdir")
+            os.mkdir(plan.path)
+        dir_fd = os.open(plan.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            STATS.count("rename", len(plan.rename))
+            STATS.count("renamed", len(plan.rename))
+            for old_name, name in plan.rename:
+                os.rename(old_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            STATS.count("unlink", len(plan.remove))
+            STATS.count("removed", len(plan.remove))
+            for name in plan.remove:
+                os.unlink(name, dir_fd=dir_fd)
+            changes = [(name, source, False) for name, source in plan.create]
+            changes.extend((name, source, True) for name, source in plan.replace)
+            if force:
+                changes.extend((name, source, True) for name, source, _current in plan.conflicts)
+            else:
+                failed += len(plan.conflicts)
+            for name, source, replace in changes:
+                if plan.mode in COPY_MODES:
+                    copies.append((source, os.path.join(plan.path, name), replace))
+                    continue
+                try:
+                    (replace_entry if replace else create_entry)(source, name, plan.mode, dir_fd)
+                    STATS.count("replaced" if replace else "created")
+                except OSError as error:
+                    logging.error("Cannot create %s: %s", os.path.join(plan.path, name), error)
+                    failed += 1
+        finally:
+            os.close(dir_fd)
+    if copies:
+        failed += copy_files(copies, plans[0].mode, jobs)
+    STATS.count("failed", failed)
+    return failed
+
+
+def execute_plans(plans, force=False, dry_run=False, jobs=16):
+    '''Logs plans and applies them unless dry_run is set
 
-    counter = 0
+    Nothing is changed if there are conflicts and force is not set.
+    Returns the number of conflicts or entries which could not be created.'''
+    with STATS.phase("diff"):
+        conflicts = log_plans(plans)
+    if dry_run:
+        return conflicts
+    if conflicts and not force:
+        logging.error("Nothing changed because of %d conflicts. Use --force to replace them.",
+                      conflicts)
+        return conflicts
+    with STATS.phase("apply"):
+        return apply_plans(plans, force, jobs)
 
-    for entry in filelist:
-        old_filename = os.path.basename(entry)
-        new_filename = "%03d_%s" % (counter, old_filename)
-        new_pathname = os.path.join(outdir, new_filename)
-        check_and_create_symlink(entry, new_pathname)
-        counter = counter + 1
+
+def symlink_files(filelist, outdir, force=False, dry_run=False, sync=False, mode="symlink",
+                  jobs=16):
+    '''Symlinks the files in list to outdir.
+
+    All filenames are pretended by 000_, 001_, 002_ etc. With sync all other
+    symlinks in outdir are renamed or removed, see FolderPlan.sync(). mode
+    selects symlinks, hardlinks, reflinks or copies, see MODES.
+    Returns the number of entries which could not be created or replaced.'''
+    plan = FolderPlan(outdir, mode)
+    for name, source in get_numbered_names(filelist):
+        plan.add(name, source)
+    if sync:
+        plan.sync()
+    return execute_plans([plan], force, dry_run, jobs)
 
 
 def get_dest_path(root, dir_entry, indir, outdir):
@@ -105,35 +776,70 @@ def get_dest_path(root, dir_entry, indir, outdir):
     return dest_path
 
 
-def generate_folder_structure(indir, outdir):
+def plan_folder_structure(indir, outdir, cache=None, jobs=16, sync=False, mode="symlink"):
+    '''Returns a list of FolderPlan for every folder in indir, parents first
+
+    Every folder in outdir is listed only once. The filelists are loaded
+    together with load_filelists() after the walk. With sync the plans
+    contain the changes to remove stale symlinks, see FolderPlan.sync().'''
+    plans = []
+    filelists = []
+    with STATS.phase("walk"):
+        for root, _dirs, files in os.walk(indir):
+            STATS.count("scandir")
+            abs_root = os.path.abspath(root)
+            plan = FolderPlan(os.path.normpath(get_dest_path(root, "", indir, outdir)), mode)
+            for file_ in files:
+                full_path = os.path.join(root, file_)
+                if file_ == "filelist.txt":
+                    # Read content of filelist.txt and plan symlinks for all the files
+                    logging.debug("found filelist at %s", full_path)
+                    filelists.append((plan, full_path))
+                else:
+                    # Symlink single file
+                    logging.debug("found other file %s", full_path)
+                    plan.add(file_, os.path.join(abs_root, file_))
+            plans.append(plan)
+    entries = load_filelists([path for _plan, path in filelists], cache, jobs)
+    with STATS.phase("plan"):
+        for plan, path in filelists:
+            for name, source in get_numbered_names(entries[path]):
+                plan.add(name, source)
+        if sync:
+            for plan in plans:
+                plan.sync()
+    return plans
+
+
+def generate_folder_structure(indir, outdir, force=False, dry_run=False, cache=None, jobs=16,
+                              sync=False, mode="symlink"):
     '''Iterates over folder structure in indir and generates folder structure in outdir
 
     * any subfolder in indir will be also created in outdir
     * filelist.txt files are parsed and the containing file names are symlinked
     * any other file will be symlinked to indir
+
+    All changes are planned first and only applied if there are no conflicts
+    (or force is set), so outdir is never left half-built. Parsed filelists
+    are cached in cache if given. With sync symlinks which are not planned
+    anymore are renamed or removed and outdated ones are replaced. mode
+    selects symlinks, hardlinks, reflinks or copies, see MODES.
+    Returns the number of entries which could not be created or replaced.
     '''
-    for root, dirs, files in os.walk(indir):
-        for file_ in files:
-            full_path = os.path.join(root, file_)
-            if file_ == "filelist.txt":
-                # Read content of filelist.txt and create symlinks for all the files
-                logging.debug("found filelist at %s", full_path)
-                filelist = read_list(full_path)
-                symlink_files(filelist, get_dest_path(root, "", indir, outdir))
-            else:
-                # Symlink single file
-                logging.debug("found other file %s", full_path)
-                dest_path = get_dest_path(root, file_, indir, outdir)
-                check_and_create_symlink(os.path.abspath(full_path), dest_path)
-        for dir_ in dirs:
-            full_path = os.path.join(root, dir_)
-            logging.debug("found dir %s", full_path)
-            dest_path = get_dest_path(root, dir_, indir, outdir)
-            if not os.path.exists(dest_path):
-                logging.info(" Create dir %s", dest_path)
-                os.mkdir(dest_path)
-            else:
-                logging.debug(" Dir %s already exists. Skip", dest_path)
+    return execute_plans(plan_folder_structure(indir, outdir, cache, jobs, sync, mode), force,
+                         dry_run, jobs)
+
+
+def run(args):
+    '''Generates the folder structure for the parsed args, returns the number of failures'''
+    cache = None if args.no_cache else ListCache(args.cache)
+    try:
+        return generate_folder_structure(args.indir, args.outdir, args.force, args.dry_run,
+                                         cache, args.jobs, args.sync, args.mode)
+    finally:
+        if cache is not None:
+            cache.close()
+            logging.debug("filelist cache: %d hits, %d misses", cache.hits, cache.misses)
 
 
 def main():
@@ -143,11 +849,19 @@ def main():
     if not os.path.isdir(args.indir):
         logging.error("Given argument is not a directory: %s. Exit.", args.indir)
         sys.exit(1)
-    if not os.path.isdir(args.outdir):
-        os.mkdir(args.outdir)
-
-
-    generate_folder_structure(args.indir, args.outdir)
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            failed = profiler.runcall(run, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            logging.info("Profile written to %s", args.profile)
+    else:
+        failed = run(args)
+    if args.stats:
+        STATS.log()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()